@@ -9,6 +9,8 @@ DESCRIPTION = """
 
 
 def parse_args() -> argparse.Namespace:
+    from yadt import onnx_session
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="127.0.0.1")
     parser.add_argument("--port", type=int, default=7860)
@@ -16,6 +18,47 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--score-slider-step", type=float, default=0.05)
     parser.add_argument("--score-general-threshold", type=float, default=0.35)
     parser.add_argument("--score-character-threshold", type=float, default=0.9)
+    parser.add_argument(
+        "--score-floor",
+        type=float,
+        default=0.05,
+        help="lowest tag score kept in the dataset cache, thresholds below it have no effect on datasets",
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument(
+        "--uint8-input", action="store_true", help="feed the WD taggers uint8 batches, casting them inside the model"
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=None, help="only return the k best scoring tags from the WD taggers, plus ratings"
+    )
+    parser.add_argument(
+        "--precision", type=str, choices=["fp32", "bf16", "fp16"], default=None, help="precision of the Camie taggers"
+    )
+    parser.add_argument(
+        "--torch-compile", action="store_true", help="compile the Camie taggers with torch.compile when loading them"
+    )
+    parser.add_argument(
+        "--camie-tag-context-size",
+        type=int,
+        default=None,
+        help="how many top initial tags the Camie refinement attends to, e.g. 64 or 128 instead of 256 for speed",
+    )
+    parser.add_argument(
+        "--camie-cascade-band",
+        type=float,
+        default=None,
+        help="only refine the Camie predictions of images with a tag this close to its threshold",
+    )
+    parser.add_argument(
+        "--camie-backend",
+        type=str,
+        choices=["torch", "onnx"],
+        default=None,
+        help="run the Camie taggers on torch, or on onnxruntime from an ONNX export made on first use",
+    )
+    parser.add_argument("--model-config", type=str, default=None, help="JSON file with per-model load options")
+    parser.add_argument("--model-cache-dir", type=str, default=None, help="folder for optimized and derived models")
+    onnx_session.add_session_arguments(parser)
     parser.add_argument("--share", action="store_true")
     return parser.parse_args()
 
@@ -27,6 +70,11 @@ def main():
 
     args = parse_args()
 
+    if args.model_cache_dir is not None:
+        from yadt import model_cache
+
+        model_cache.set_cache_dir(args.model_cache_dir)
+
     if args.device == "auto":
         import torch
 
@@ -0,0 +1,498 @@
+"""
+Benchmarks for the Camie taggers.
+
+Example:
+    python -m yadt.benchmark_camie precision --model "Camais03/camie-tagger" --precisions fp32 bf16
+    python -m yadt.benchmark_camie int8 --model "Camais03/camie-tagger"
+    python -m yadt.benchmark_camie load --model "Camais03/camie-tagger"
+    python -m yadt.benchmark_camie preprocess --model "Camais03/camie-tagger" --images ./dataset
+    python -m yadt.benchmark_camie cascade --model "Camais03/camie-tagger" --threshold-profile balanced
+    python -m yadt.benchmark_camie context --model "Camais03/camie-tagger" --sizes 256 128 64
+"""
+
+import argparse
+import time
+
+from yadt.benchmark_smilingwolf import _reset_peak_rss, _rss, load_images
+
+
+def _predict_probabilities(predictor, images, batch_size: int):
+    """Runs the model over the images and returns the refined probabilities of all tags, on the CPU"""
+    import torch
+
+    # The onnx backend returns NumPy arrays, the torch one tensors
+    return torch.cat(
+        [
+            torch.as_tensor(predictor.model.predict_batch(images[i : i + batch_size])["refined_probabilities"]).cpu()
+            for i in range(0, len(images), batch_size)
+        ]
+    )
+
+
+def _report_agreement(name: str, probs, reference, top_k: int):
+    """Prints how far the probabilities are from the reference ones, and how many of the top-k tags they share"""
+    import torch
+
+    max_deviations = (probs - reference).abs().amax(dim=1)
+
+    _, reference_top_k = torch.topk(reference, top_k, dim=1)
+    _, probs_top_k = torch.topk(probs, top_k, dim=1)
+    overlaps = [len(set(a.tolist()) & set(b.tolist())) / top_k for a, b in zip(probs_top_k, reference_top_k)]
+
+    print(
+        f"{name}: max score deviation {max_deviations.max().item():.4f} "
+        f"(mean per image {max_deviations.mean().item():.4f}), "
+        f"top-{top_k} agreement {sum(overlaps) / len(overlaps):.2%} (min {min(overlaps):.2%})"
+    )
+
+
+def benchmark_precision(args):
+    from yadt.tagger_camie import Predictor
+
+    images = load_images(args.images, args.count)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    # fp32 is the reference every other precision is compared against
+    precisions = ["fp32", *[precision for precision in args.precisions if precision != "fp32"]]
+
+    probabilities = {}
+    for precision in precisions:
+        predictor = Predictor()
+        predictor.load_model(args.model, device=args.device, precision=precision, batch_size=args.batch_size)
+
+        if predictor.model.precision != precision:
+            print(f"{precision:>5}: not supported on {args.device}, skipped")
+            continue
+
+        # Warm up, so the first batch's one-time initialization isn't measured
+        _predict_probabilities(predictor, images[: args.batch_size], args.batch_size)
+
+        start_t = time.perf_counter()
+        probabilities[precision] = _predict_probabilities(predictor, images, args.batch_size)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"{precision:>5}: {1000 * elapsed_t / len(images):8.2f} ms/image")
+        del predictor
+
+    reference = probabilities.pop("fp32")
+    for precision, probs in probabilities.items():
+        _report_agreement(f"{precision:>5} vs fp32", probs, reference, args.top_k)
+
+
+def benchmark_compile(args):
+    import torch
+
+    from yadt.tagger_camie import Predictor
+
+    images = load_images(args.images, args.count)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    probabilities = {}
+    for torch_compile in (False, True):
+        name = "compiled" if torch_compile else "eager"
+
+        start_t = time.perf_counter()
+        predictor = Predictor()
+        predictor.load_model(
+            args.model,
+            device=args.device,
+            precision=args.precision,
+            batch_size=args.batch_size,
+            torch_compile=torch_compile,
+        )
+        load_t = time.perf_counter() - start_t
+
+        # Warm up, so the first batch's one-time initialization isn't measured
+        _predict_probabilities(predictor, images[: args.batch_size], args.batch_size)
+
+        latencies = []
+        results = []
+        for i in range(0, len(images), args.batch_size):
+            start_t = time.perf_counter()
+            results.append(_predict_probabilities(predictor, images[i : i + args.batch_size], args.batch_size))
+            latencies.append(time.perf_counter() - start_t)
+
+        probabilities[name] = torch.cat(results)
+        latencies = torch.tensor(latencies)
+
+        print(
+            f"{name:>8}: load {load_t:6.1f}s, {1000 * latencies.mean().item():8.2f} ms/batch "
+            f"(min {1000 * latencies.min().item():.2f}, max {1000 * latencies.max().item():.2f}), "
+            f"{1000 * latencies.sum().item() / len(images):8.2f} ms/image"
+        )
+        del predictor
+
+    max_deviation = (probabilities["compiled"] - probabilities["eager"]).abs().max().item()
+    print(f"max score deviation: {max_deviation:.6f}")
+
+
+def benchmark_int8(args):
+    from yadt import onnx_session
+    from yadt.tagger_camie import INT8_VARIANT_SUFFIX, Predictor
+
+    images = load_images(args.images, args.count)
+    model_repo = args.model.removesuffix(INT8_VARIANT_SUFFIX)
+
+    print(f"* Model: {model_repo}")
+    print(f"* Images: {len(images)}")
+
+    # The fp32 torch model is the reference, the fp32 export shows how much of the difference is onnxruntime's
+    variants = {
+        "fp32 torch": (model_repo, "torch"),
+        "fp32 onnx": (model_repo, "onnx"),
+        "int8 onnx": (model_repo + INT8_VARIANT_SUFFIX, "onnx"),
+    }
+
+    probabilities = {}
+    for name, (variant_repo, backend) in variants.items():
+        # The first load of the onnx variants includes exporting and quantizing the model
+        start_t = time.perf_counter()
+        predictor = Predictor()
+        predictor.load_model(
+            variant_repo,
+            device="cpu",
+            backend=backend,
+            batch_size=args.batch_size,
+            **onnx_session.session_kwargs(args),
+        )
+        load_t = time.perf_counter() - start_t
+
+        # Warm up, so the first batch's one-time initialization isn't measured
+        _predict_probabilities(predictor, images[: args.batch_size], args.batch_size)
+
+        start_t = time.perf_counter()
+        probabilities[name] = _predict_probabilities(predictor, images, args.batch_size)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"{name:>10}: load {load_t:6.1f}s, {1000 * elapsed_t / len(images):8.2f} ms/image")
+        del predictor
+
+    reference = probabilities.pop("fp32 torch")
+    for name, probs in probabilities.items():
+        _report_agreement(f"{name:>10} vs fp32 torch", probs, reference, args.top_k)
+
+
+def _load_worker(model_repo: str, fast_load: bool, device: str, results):
+    import os
+
+    import torch  # noqa: F401, imported before the baseline so it isn't counted
+
+    from yadt.tagger_camie import CAMIE_MODEL_FULL, Predictor
+    from yadt.tagger_camie_model import load_model
+
+    full_model = os.path.isdir(model_repo) or model_repo == CAMIE_MODEL_FULL
+    metadata_path, model_info_path, state_dict_path = Predictor().download_model(
+        model_repo if os.path.isdir(model_repo) else CAMIE_MODEL_FULL, full_model
+    )
+
+    # Everything measured on top of the memory in use now is the loading overhead
+    _reset_peak_rss()
+    baseline_rss = _rss("VmRSS")
+
+    start_t = time.perf_counter()
+    load_model(
+        ".",
+        full=full_model,
+        metadata_path=metadata_path,
+        model_info_path=model_info_path,
+        state_dict_path=state_dict_path,
+        device=device,
+        fast_load=fast_load,
+    )
+    elapsed_t = time.perf_counter() - start_t
+
+    results.put((elapsed_t, _rss("VmRSS") - baseline_rss, _rss("VmHWM") - baseline_rss))
+
+
+def benchmark_load(args):
+    import multiprocessing
+
+    print(f"* Model: {args.model}")
+
+    # Every load runs in a fresh process, so the peak memory of one doesn't hide the other.
+    # The first run also warms the page cache, so "regular" is run again after it for a fair comparison.
+    context = multiprocessing.get_context("spawn")
+
+    for fast_load in (False, *[False, True] * args.repeat):
+        results = context.Queue()
+        process = context.Process(target=_load_worker, args=(args.model, fast_load, args.device, results))
+        process.start()
+        elapsed_t, rss, peak_rss = results.get()
+        process.join()
+        assert process.exitcode == 0, "Load benchmark failed"
+
+        name = "fast" if fast_load else "regular"
+        print(f"{name:>8}: {elapsed_t:6.2f}s, RSS +{rss / 1024**2:.1f} MiB, peak RSS +{peak_rss / 1024**2:.1f} MiB")
+
+
+def benchmark_preprocess(args):
+    import numpy as np
+
+    from yadt.tagger_camie import Predictor
+    from yadt.tagger_camie_preprocess import letterbox_into
+
+    images = load_images(args.images, args.count, args.random_size)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    predictor = Predictor()
+    predictor.load_model(
+        args.model,
+        device=args.device,
+        backend=args.backend,
+        batch_size=args.batch_size,
+        preprocess_workers=args.workers,
+    )
+    model, preprocessor = predictor.model, predictor.preprocessor
+
+    print(f"* Preprocessing workers: {preprocessor.num_workers}")
+
+    # Warm up, so the first batch's one-time initialization isn't measured
+    model.predict_batch(images[: args.batch_size])
+
+    # Sequential: every batch is preprocessed on the main thread, then run through the model
+    buffer = np.zeros((args.batch_size, 3, preprocessor.image_size, preprocessor.image_size), dtype=np.float32)
+    preprocess_t, inference_t = 0.0, 0.0
+    for i in range(0, len(images), args.batch_size):
+        batch_images = images[i : i + args.batch_size]
+
+        start_t = time.perf_counter()
+        batch = buffer[: len(batch_images)]
+        for image, out in zip(batch_images, batch):
+            letterbox_into(image, out)
+        preprocess_t += time.perf_counter() - start_t
+
+        start_t = time.perf_counter()
+        model.predict_preprocessed(batch)
+        inference_t += time.perf_counter() - start_t
+
+    sequential_t = preprocess_t + inference_t
+
+    # Pipelined: the next batch is preprocessed on the worker threads while the model runs the current one
+    start_t = time.perf_counter()
+    for batch in preprocessor.batches(images):
+        model.predict_preprocessed(batch)
+    pipelined_t = time.perf_counter() - start_t
+
+    hidden_t = max(0.0, sequential_t - pipelined_t)
+
+    print(
+        f"sequential: {sequential_t:7.2f}s (preprocessing {preprocess_t:.2f}s, inference {inference_t:.2f}s), "
+        f"{1000 * sequential_t / len(images):8.2f} ms/image"
+    )
+    print(f" pipelined: {pipelined_t:7.2f}s, {1000 * pipelined_t / len(images):8.2f} ms/image")
+    print(
+        f"preprocessing overlapped with inference: {hidden_t:.2f}s of {preprocess_t:.2f}s ({hidden_t / preprocess_t:.0%})"
+    )
+
+
+def _prediction_agreement(predictions, reference):
+    """Mean Jaccard similarity of the predicted tag sets per image, and the fraction of images with the same tags"""
+    predictions, reference = predictions.bool(), reference.bool()
+    both = (predictions & reference).sum(dim=1)
+    either = (predictions | reference).sum(dim=1)
+
+    # Two empty tag sets agree completely
+    jaccard = (both / either.clamp(min=1)).where(either > 0, 1.0)
+    return jaccard.mean().item(), (both == either).float().mean().item()
+
+
+def benchmark_cascade(args):
+    import json
+
+    import torch
+
+    from yadt.tagger_camie import Predictor
+    from yadt.tagger_camie_dataset import thresholds_for_profile
+    from yadt.tagger_camie_model import set_cascade
+
+    # Like load_model, a band of 0 would turn the cascade off
+    assert all(0 < band < 1 for band in args.bands), "Cascade bands must be between 0 and 1"
+
+    images = load_images(args.images, args.count)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    predictor = Predictor()
+    predictor.load_model(args.model, device=args.device, precision=args.precision, batch_size=args.batch_size)
+    model = predictor.model
+
+    category_thresholds, tag_thresholds = None, None
+    if args.threshold_profile:
+        thresholds_path = predictor.download_thresholds(args.model)
+        assert thresholds_path, "No thresholds.json found for the threshold profile"
+        with open(thresholds_path, "r") as f:
+            category_thresholds, tag_thresholds = thresholds_for_profile(json.load(f), args.threshold_profile)
+
+    print(f"* Thresholds: {args.threshold_profile or args.threshold}")
+
+    def predict():
+        return torch.cat(
+            [
+                model.predict_preprocessed(
+                    batch,
+                    threshold=args.threshold,
+                    category_thresholds=category_thresholds,
+                    tag_thresholds=tag_thresholds,
+                )["predictions"].cpu()
+                for batch in predictor.preprocessor.batches(images)
+            ]
+        )
+
+    # Warm up, so the first batch's one-time initialization isn't measured
+    model.predict_batch(images[: args.batch_size])
+
+    # Every image refined is the reference
+    reference = None
+    for band in (None, *args.bands):
+        set_cascade(model, band, args.threshold, category_thresholds, tag_thresholds)
+
+        start_t = time.perf_counter()
+        predictions = predict()
+        elapsed_t = time.perf_counter() - start_t
+
+        name = f"band {band}" if band is not None else "no cascade"
+        stats = model.cascade_stats
+        refined = stats["refined"] / stats["images"] if band is not None else 1.0
+
+        line = f"{name:>12}: {len(images) / elapsed_t:6.2f} images/s, {refined:.0%} of the images refined"
+        if reference is None:
+            reference = predictions
+        else:
+            jaccard, exact = _prediction_agreement(predictions, reference)
+            line += f", tag agreement {jaccard:.2%} (same tags for {exact:.0%} of the images)"
+
+        print(line)
+
+
+def benchmark_context(args):
+    import torch
+
+    from yadt.tagger_camie import Predictor
+    from yadt.tagger_camie_model import set_tag_context_size
+
+    images = load_images(args.images, args.count)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    predictor = Predictor()
+    predictor.load_model(args.model, device=args.device, precision=args.precision, batch_size=args.batch_size)
+    model = predictor.model
+
+    # The size the model was trained with is the reference
+    default_size = model.tag_context_size
+    sizes = [default_size, *[size for size in args.sizes if size != default_size]]
+
+    # Warm up, so the first batch's one-time initialization isn't measured
+    _predict_probabilities(predictor, images[: args.batch_size], args.batch_size)
+
+    probabilities = {}
+    for size in sizes:
+        set_tag_context_size(model, size)
+
+        start_t = time.perf_counter()
+        probabilities[size] = _predict_probabilities(predictor, images, args.batch_size)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"context {size:>4}: {1000 * elapsed_t / len(images):8.2f} ms/image")
+
+    set_tag_context_size(model, default_size)
+
+    reference = probabilities.pop(default_size)
+    for size, probs in probabilities.items():
+        jaccard, exact = _prediction_agreement(probs >= args.threshold, reference >= args.threshold)
+        _report_agreement(f"context {size:>4} vs {default_size}", probs, reference, args.top_k)
+        print(f"{'':>17}  tags at {args.threshold}: agreement {jaccard:.2%} (same tags for {exact:.0%} of the images)")
+
+
+def parse_args() -> argparse.Namespace:
+    from yadt import onnx_session
+    from yadt.tagger_camie import CAMIE_MODEL_FULL
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the Camie taggers")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    precision = subparsers.add_parser("precision", help="latency and score parity of the precisions against fp32")
+    precision.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    precision.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    precision.add_argument("--count", type=int, default=16)
+    precision.add_argument("--batch-size", type=int, default=4)
+    precision.add_argument("--device", type=str, default="cpu")
+    precision.add_argument("--precisions", type=str, nargs="+", default=["fp32", "bf16", "fp16"])
+    precision.add_argument("--top-k", type=int, default=20)
+    precision.set_defaults(fn=benchmark_precision)
+
+    compiled = subparsers.add_parser("compile", help="latency of the eager and the compiled (torch.compile) models")
+    compiled.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    compiled.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    compiled.add_argument("--count", type=int, default=16)
+    compiled.add_argument("--batch-size", type=int, default=4)
+    compiled.add_argument("--device", type=str, default="cpu")
+    compiled.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"], default="fp32")
+    compiled.set_defaults(fn=benchmark_compile)
+
+    int8 = subparsers.add_parser("int8", help="latency and agreement of the INT8 variant with the fp32 model")
+    int8.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    int8.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    int8.add_argument("--count", type=int, default=16)
+    int8.add_argument("--batch-size", type=int, default=4)
+    int8.add_argument("--top-k", type=int, default=20)
+    onnx_session.add_session_arguments(int8)
+    int8.set_defaults(fn=benchmark_int8)
+
+    load = subparsers.add_parser("load", help="time and memory of loading the model, regular and fast (mmap)")
+    load.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    load.add_argument("--device", type=str, default="cpu")
+    load.add_argument("--repeat", type=int, default=1)
+    load.set_defaults(fn=benchmark_load)
+
+    preprocess = subparsers.add_parser("preprocess", help="how much preprocessing overlaps with inference")
+    preprocess.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    preprocess.add_argument(
+        "--images", type=str, default=None, help="folder of images, random images are used if unset"
+    )
+    preprocess.add_argument("--count", type=int, default=16)
+    preprocess.add_argument("--random-size", type=int, nargs=2, default=[1024, 3072], help="random image size range")
+    preprocess.add_argument("--batch-size", type=int, default=4)
+    preprocess.add_argument("--device", type=str, default="cpu")
+    preprocess.add_argument("--backend", type=str, choices=["torch", "onnx"], default="torch")
+    preprocess.add_argument("--workers", type=int, default=None, help="preprocessing threads, up to the batch size")
+    preprocess.set_defaults(fn=benchmark_preprocess)
+
+    cascade = subparsers.add_parser("cascade", help="throughput and agreement of the cascade at different bands")
+    cascade.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    cascade.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    cascade.add_argument("--count", type=int, default=16)
+    cascade.add_argument("--batch-size", type=int, default=4)
+    cascade.add_argument("--device", type=str, default="cpu")
+    cascade.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"], default="fp32")
+    cascade.add_argument("--bands", type=float, nargs="+", default=[0.2, 0.1, 0.05, 0.02])
+    cascade.add_argument("--threshold", type=float, default=0.35, help="threshold for all tags without a profile")
+    cascade.add_argument("--threshold-profile", type=str, default=None, help="thresholds.json profile, e.g. balanced")
+    cascade.set_defaults(fn=benchmark_cascade)
+
+    context = subparsers.add_parser("context", help="latency and agreement of smaller tag context sizes")
+    context.add_argument("--model", type=str, default=CAMIE_MODEL_FULL)
+    context.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    context.add_argument("--count", type=int, default=16)
+    context.add_argument("--batch-size", type=int, default=4)
+    context.add_argument("--device", type=str, default="cpu")
+    context.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"], default="fp32")
+    context.add_argument("--sizes", type=int, nargs="+", default=[256, 128, 64, 32])
+    context.add_argument("--threshold", type=float, default=0.35)
+    context.add_argument("--top-k", type=int, default=20)
+    context.set_defaults(fn=benchmark_context)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.fn(args)
@@ -0,0 +1,118 @@
+"""
+Benchmarks for the Florence-2 PromptGen tagger.
+
+Example:
+    python -m yadt.benchmark_florence2 batch --model MiaoshouAI/Florence-2-base-PromptGen-v2.0 --batch-sizes 1 2 4 8
+    python -m yadt.benchmark_florence2 repetition --images ./dataset --decoding-profile greedy
+"""
+
+import argparse
+import time
+
+from yadt.benchmark_smilingwolf import load_images
+
+
+def benchmark_batch(args):
+    from yadt.tagger_florence2_promptgen import Predictor
+
+    images = load_images(args.images, args.count)
+
+    predictor = Predictor()
+    predictor.load_model(args.model, device=args.device, batch_size=max(args.batch_sizes))
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    # Warm up, so the first measurement doesn't include any lazy initialization
+    predictor.predict_batch(images[:1])
+
+    results = {}
+    for batch_size in args.batch_sizes:
+        start_t = time.perf_counter()
+        results[batch_size] = predictor.predict_batch(images, batch_size=batch_size)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"batch size {batch_size:>4}: {len(images) / elapsed_t:8.3f} images/s")
+
+    # Beam search on a batch should find the same tags as on single images
+    reference_batch_size = min(args.batch_sizes)
+    for batch_size, predictions in results.items():
+        if batch_size != reference_batch_size:
+            same = sum(
+                prediction[1].keys() == reference[1].keys()
+                for prediction, reference in zip(predictions, results[reference_batch_size])
+            )
+            print(
+                f"batch size {batch_size:>4}: same tags as batch size {reference_batch_size} for {same}/{len(images)}"
+            )
+
+
+def benchmark_repetition(args):
+    from yadt.tagger_florence2_promptgen import Predictor
+
+    images = load_images(args.images, args.count)
+
+    predictor = Predictor()
+    predictor.load_model(args.model, device=args.device, batch_size=args.batch_size)
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+    print(f"* Decoding profile: {args.decoding_profile}")
+
+    results = {}
+    for window in (0, args.window):
+        predictor.repetition_window = window
+
+        start_t = time.perf_counter()
+        results[window] = predictor.predict_batch(images, decoding_profile=args.decoding_profile)
+        elapsed_t = time.perf_counter() - start_t
+
+        name = f"window {window}" if window else "no early stop"
+        print(f"{name:>13}: {1000 * elapsed_t / len(images):10.2f} ms/image")
+
+    for i, tokens_saved in enumerate(predictor.tokens_saved):
+        if tokens_saved:
+            print(f"image {i:>4}: stopped early, saving {tokens_saved} tokens")
+
+    # Stopping a loop should only lose its repeats, and at most the unique tags after them
+    same = sum(stopped[1].keys() == reference[1].keys() for stopped, reference in zip(results[args.window], results[0]))
+    print(f"tokens saved: {sum(predictor.tokens_saved)} ({sum(predictor.tokens_saved) / len(images):.1f} per image)")
+    print(f"same tags as without early stopping for {same}/{len(images)}")
+
+
+def parse_args() -> argparse.Namespace:
+    from yadt.tagger_florence2_promptgen import (
+        DECODING_PROFILES,
+        DEFAULT_REPETITION_WINDOW,
+        FLORENCE2_PROMPTGEN_BASE,
+    )
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the Florence-2 PromptGen tagger")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batch = subparsers.add_parser("batch", help="throughput (images/s) at different batch sizes")
+    batch.add_argument("--model", type=str, default=FLORENCE2_PROMPTGEN_BASE)
+    batch.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    batch.add_argument("--count", type=int, default=16)
+    batch.add_argument("--device", type=str, default="cpu")
+    batch.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    batch.set_defaults(fn=benchmark_batch)
+
+    repetition = subparsers.add_parser("repetition", help="time and tokens saved by stopping looping generations")
+    repetition.add_argument("--model", type=str, default=FLORENCE2_PROMPTGEN_BASE)
+    repetition.add_argument(
+        "--images", type=str, default=None, help="folder of images, random images are used if unset"
+    )
+    repetition.add_argument("--count", type=int, default=16)
+    repetition.add_argument("--device", type=str, default="cpu")
+    repetition.add_argument("--batch-size", type=int, default=1)
+    repetition.add_argument("--decoding-profile", type=str, choices=list(DECODING_PROFILES), default="greedy")
+    repetition.add_argument("--window", type=int, default=DEFAULT_REPETITION_WINDOW)
+    repetition.set_defaults(fn=benchmark_repetition)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.fn(args)
@@ -0,0 +1,221 @@
+"""
+Benchmarks for the SmilingWolf ONNX taggers.
+
+Example:
+    python -m yadt.benchmark_smilingwolf batch --model SmilingWolf/wd-vit-tagger-v3 --batch-sizes 1 8 32
+"""
+
+import argparse
+import os
+import time
+
+from PIL import Image
+
+
+def load_images(folder: str, count: int, random_size=(512, 1536), seed: int = 0):
+    """Loads up to `count` images from a folder, or generates random noise images when no folder is given"""
+    import numpy as np
+
+    if folder:
+        images = []
+        for file in sorted(os.listdir(folder)):
+            try:
+                image = Image.open(os.path.join(folder, file))
+                image.load()
+            except Exception:
+                continue
+
+            images.append(image)
+            if len(images) >= count:
+                break
+
+        assert len(images) > 0, f"No images found in {folder}"
+        return images
+
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(*rng.integers(*random_size, size=2), 3), dtype=np.uint8))
+        for _ in range(count)
+    ]
+
+
+def benchmark_batch(args):
+    from yadt import onnx_session
+    from yadt.tagger_smilingwolf import Predictor
+
+    images = load_images(args.images, args.count)
+
+    predictor = Predictor()
+    predictor.load_model(args.model, batch_size=max(args.batch_sizes), **onnx_session.session_kwargs(args))
+
+    print(f"* Model: {args.model}")
+    print(f"* Images: {len(images)}")
+
+    # Warm up the session so the first measurement doesn't include any lazy initialization
+    predictor.predict_batch(images[: max(args.batch_sizes)])
+
+    for batch_size in args.batch_sizes:
+        start_t = time.perf_counter()
+        for _ in range(args.repeat):
+            predictor.predict_batch(images, batch_size=batch_size)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"batch size {batch_size:>4}: {len(images) * args.repeat / elapsed_t:8.2f} images/s")
+
+
+def _rss(field: str) -> int:
+    """Reads the current (VmRSS) or peak (VmHWM) resident memory of this process in bytes"""
+    import resource
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Without procfs there's only the peak, which can't be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _preprocess_worker(path: str, images: str, count: int, random_size, size: int, results):
+    import numpy as np
+
+    from yadt.tagger_smilingwolf import Predictor
+
+    predictor = Predictor()
+    predictor.model_target_size = size
+
+    images = load_images(images, count, random_size)
+    out = np.empty((size, size, 3), dtype=np.float32)
+
+    # Everything measured on top of the memory in use now is the preprocessing overhead
+    _reset_peak_rss()
+    baseline_rss = _rss("VmRSS")
+
+    start_t = time.perf_counter()
+    for image in images:
+        if path == "current":
+            out[...] = predictor.prepare_image(image)[0]
+        else:
+            predictor.prepare_image_into(image, out)
+    elapsed_t = time.perf_counter() - start_t
+
+    results.put((elapsed_t / len(images), _rss("VmHWM") - baseline_rss))
+
+
+def benchmark_preprocess(args):
+    import multiprocessing
+
+    print(f"* Images: {args.images or f'{args.count} random'}")
+
+    # Every path runs in a fresh process, so the peak memory of one doesn't hide the other
+    context = multiprocessing.get_context("spawn")
+
+    for path in ("current", "buffered"):
+        results = context.Queue()
+        process = context.Process(
+            target=_preprocess_worker,
+            args=(path, args.images, args.count, args.random_size, args.size, results),
+        )
+        process.start()
+        process.join()
+        assert process.exitcode == 0, f"Preprocessing benchmark failed for the {path} path"
+
+        time_per_image, peak_memory = results.get()
+
+        print(f"{path:>8}: {1000 * time_per_image:8.2f} ms/image, peak memory +{peak_memory / 1024**2:.1f} MiB")
+
+
+def top_k_tags(results, k: int):
+    """Returns the k highest scoring general and character tags of a prediction"""
+    _, general_res, character_res = results
+    tags = sorted({**general_res, **character_res}.items(), key=lambda x: x[1], reverse=True)
+    return [tag for tag, _ in tags[:k]]
+
+
+def benchmark_agreement(args):
+    import numpy as np
+
+    from yadt import onnx_session
+    from yadt.tagger_smilingwolf import INT8_VARIANT_SUFFIX, Predictor
+
+    images = load_images(args.images, args.count)
+    model_repo = args.model.removesuffix(INT8_VARIANT_SUFFIX)
+
+    print(f"* Model: {model_repo}")
+    print(f"* Images: {len(images)}")
+
+    results = {}
+    for variant in ("", INT8_VARIANT_SUFFIX):
+        predictor = Predictor()
+        predictor.load_model(model_repo + variant, **onnx_session.session_kwargs(args))
+
+        start_t = time.perf_counter()
+        results[variant] = predictor.predict_batch(images)
+        elapsed_t = time.perf_counter() - start_t
+
+        print(f"{(variant.strip() or '(fp32)'):>8}: {1000 * elapsed_t / len(images):8.2f} ms/image")
+
+    overlaps = []
+    max_deviations = []
+    for fp32_results, int8_results in zip(results[""], results[INT8_VARIANT_SUFFIX]):
+        fp32_top_k = top_k_tags(fp32_results, args.top_k)
+        int8_top_k = top_k_tags(int8_results, args.top_k)
+        overlaps.append(len(set(fp32_top_k) & set(int8_top_k)) / max(1, len(fp32_top_k)))
+
+        fp32_scores = np.array([score for tags in fp32_results for score in tags.values()])
+        int8_scores = np.array([score for tags in int8_results for score in tags.values()])
+        max_deviations.append(np.abs(fp32_scores - int8_scores).max())
+
+    print(f"top-{args.top_k} agreement: mean {np.mean(overlaps):.2%}, min {np.min(overlaps):.2%}")
+    print(f"max score deviation: mean {np.mean(max_deviations):.4f}, max {np.max(max_deviations):.4f}")
+
+
+def parse_args() -> argparse.Namespace:
+    from yadt import onnx_session
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the SmilingWolf ONNX taggers")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batch = subparsers.add_parser("batch", help="throughput (images/s) at different batch sizes")
+    batch.add_argument("--model", type=str, default="SmilingWolf/wd-vit-tagger-v3")
+    batch.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    batch.add_argument("--count", type=int, default=64)
+    batch.add_argument("--repeat", type=int, default=1)
+    batch.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    onnx_session.add_session_arguments(batch)
+    batch.set_defaults(fn=benchmark_batch)
+
+    preprocess = subparsers.add_parser("preprocess", help="time and peak memory of the image preprocessing")
+    preprocess.add_argument(
+        "--images", type=str, default=None, help="folder of images, random images are used if unset"
+    )
+    preprocess.add_argument("--count", type=int, default=16)
+    preprocess.add_argument("--random-size", type=int, nargs=2, default=[3000, 6000], help="random image size range")
+    preprocess.add_argument("--size", type=int, default=448, help="model input size")
+    preprocess.set_defaults(fn=benchmark_preprocess)
+
+    agreement = subparsers.add_parser("agreement", help="top-k tag agreement of the INT8 variant with the FP32 model")
+    agreement.add_argument("--model", type=str, default="SmilingWolf/wd-vit-tagger-v3")
+    agreement.add_argument("--images", type=str, default=None, help="folder of images, random images are used if unset")
+    agreement.add_argument("--count", type=int, default=32)
+    agreement.add_argument("--top-k", type=int, default=20)
+    onnx_session.add_session_arguments(agreement)
+    agreement.set_defaults(fn=benchmark_agreement)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.fn(args)
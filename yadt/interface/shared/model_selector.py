@@ -1,6 +1,7 @@
 import gradio as gr
 
 from yadt import tagger_shared
+from yadt import tagger_florence2_promptgen
 
 
 def create_model_selector():
@@ -25,4 +26,10 @@ def create_model_selector():
                 label="Use Custom Model",
                 scale=1,
             )
-    return model_repo, custom_model, use_custom_model
+        decoding_profile = gr.Dropdown(
+            list(tagger_florence2_promptgen.DECODING_PROFILES),
+            value=tagger_florence2_promptgen.DEFAULT_DECODING_PROFILE,
+            label="Florence-2 decoding",
+            info="Greedy decoding is the fastest, beam search finds the best tags",
+        )
+    return model_repo, custom_model, use_custom_model, decoding_profile
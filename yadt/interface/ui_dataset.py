@@ -1,9 +1,12 @@
 import os
+from collections.abc import Sequence
+
 import gradio as gr
 
 from PIL import Image
 
 from yadt import tagger_shared
+from yadt import tagger_florence2_promptgen
 from yadt import process_prediction
 from yadt.interface import ui_utils
 from yadt.interface.shared.model_selector import create_model_selector
@@ -22,6 +25,30 @@ def save_caption_for_image_path(image_path: str, caption: str, overwrite_current
             f.write(caption)
 
 
+class LazyImages(Sequence):
+    """
+    The images of a list of paths, opened only when the taggers slice out their next batch,
+    so a whole folder can be predicted at once without keeping every image open. Reports the tagging progress.
+    """
+
+    def __init__(self, paths: list[str], progress: gr.Progress):
+        self.paths = paths
+        self.progress = progress
+        self.done = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            paths = self.paths[index]
+            self.done = min(self.done + len(paths), len(self.paths))
+            self.progress((self.done, len(self.paths)), desc="Tagging")
+            return [Image.open(path) for path in paths]
+
+        return Image.open(self.paths[index])
+
+
 def process_dataset_folder(args):
     import zlib
     import pickle
@@ -46,6 +73,7 @@ def process_dataset_folder(args):
     def _process_dataset_folder(
         folder: str,
         model_repo: str,
+        decoding_profile: str,
         general_thresh: float,
         general_mcut_enabled: bool,
         character_thresh: float,
@@ -68,6 +96,11 @@ def process_dataset_folder(args):
 
         db.update_recent_datasets(folder)
 
+        # Results of different decoding profiles, model options and score floors are cached apart, so they never mix
+        cache_key = tagger_shared.dataset_cache_key(
+            model_repo, decoding_profile, tagger_shared.model_kwargs(args), score_floor=args.score_floor
+        )
+
         # predictor.load_model(model_repo)
 
         files = os.listdir(folder)
@@ -81,25 +114,41 @@ def process_dataset_folder(args):
         all_character_res = dict()
         all_general_res = dict()
 
-        for index, file in progress.tqdm(list(enumerate(files)), desc=folder):
+        entries = []
+
+        for file in progress.tqdm(files, desc=folder):
             image_path = folder + "/" + file
 
             file_hash = hash_file(image_path)
-            file_hash_hex = file_hash.hex()
 
             try:
-                image = Image.open(image_path)
+                with Image.open(image_path):
+                    pass
             except Exception as e:
                 continue
 
-            cache = db.get_dataset_cache(file_hash, model_repo)
-            if cache is not None:
-                rating, general_res, character_res = decode_results(cache)
-            else:
-                tagger_shared.predictor.load_model(model_repo, device=args.device)
-                rating, general_res, character_res = tagger_shared.predictor.predict(image)
+            cache = db.get_dataset_cache(file_hash, cache_key)
+            results = decode_results(cache) if cache is not None else None
+
+            entries.append([image_path, file_hash, results])
+
+        # Run all the images that weren't cached through the model at once, so the taggers can keep their batches
+        # full and preprocess the next batch while the current one runs
+        uncached_entries = [entry for entry in entries if entry[2] is None]
+        if len(uncached_entries) > 0:
+            tagger_shared.predictor.load_model(model_repo, is_custom_model=False, **tagger_shared.model_kwargs(args))
+            predictions = tagger_shared.predictor.predict_batch(
+                LazyImages([entry[0] for entry in uncached_entries], progress),
+                score_floor=args.score_floor,
+                decoding_profile=decoding_profile,
+            )
 
-                db.set_dataset_cache(file_hash, model_repo, folder, encode_results(rating, general_res, character_res))
+            for entry, (rating, general_res, character_res) in zip(uncached_entries, predictions):
+                entry[2] = (rating, general_res, character_res)
+                db.set_dataset_cache(entry[1], cache_key, folder, encode_results(rating, general_res, character_res))
+
+        for image_path, file_hash, (rating, general_res, character_res) in entries:
+            file_hash_hex = file_hash.hex()
 
             sorted_general_strings, rating, general_res, character_res = process_prediction.post_process_prediction(
                 rating,
@@ -109,10 +158,6 @@ def process_dataset_folder(args):
                 general_mcut_enabled,
                 character_thresh,
                 character_mcut_enabled,
-                general_thresh,
-                False,
-                character_thresh,
-                False,
                 replace_underscores,
                 trim_general_tag_dupes,
                 escape_brackets,
@@ -131,15 +176,12 @@ def process_dataset_folder(args):
             else:
                 sorted_general_strings_post = sorted_general_strings
 
-            # print('===', file)
-            # print(sorted_general_strings)
-            # print('')
-
             all_count += 1
 
             temp_image_path = temp_folder_gallery_path(args, file_hash_hex)
             if not os.path.exists(temp_image_path):
-                image.convert("RGB").save(temp_image_path, quality=85)
+                with Image.open(image_path) as image:
+                    image.convert("RGB").save(temp_image_path, quality=85)
 
             all_images.append((file_hash_hex, [image_path, sorted_general_strings, sorted_general_strings_post]))
 
@@ -228,6 +270,7 @@ def load_recent_datasets():
 
 def load_dataset_settings(args):
     model_repo_default = tagger_shared.default_repo
+    decoding_profile_default = tagger_florence2_promptgen.DEFAULT_DECODING_PROFILE
     general_thresh_default = args.score_general_threshold
     general_mcut_enabled_default = "False"
     character_thresh_default = args.score_character_threshold
@@ -244,6 +287,7 @@ def load_dataset_settings(args):
     @ui_utils.gradio_warning(
         default=[
             model_repo_default,
+            decoding_profile_default,
             general_thresh_default,
             general_mcut_enabled_default,
             character_thresh_default,
@@ -262,6 +306,9 @@ def load_dataset_settings(args):
         from yadt.db_dataset import db
 
         model_repo = str(db.get_dataset_setting(folder, "model_repo", default=model_repo_default))
+        decoding_profile = str(db.get_dataset_setting(folder, "decoding_profile", default=decoding_profile_default))
+        if decoding_profile not in tagger_florence2_promptgen.DECODING_PROFILES:
+            decoding_profile = decoding_profile_default
         general_thresh = float(db.get_dataset_setting(folder, "general_thresh", default=general_thresh_default))
         general_mcut_enabled = (
             db.get_dataset_setting(folder, "general_mcut_enabled", default=general_mcut_enabled_default)
@@ -287,6 +334,7 @@ def load_dataset_settings(args):
 
         return [
             model_repo,
+            decoding_profile,
             general_thresh,
             general_mcut_enabled,
             character_thresh,
@@ -309,6 +357,7 @@ def save_dataset_settings(args):
     def _save_dataset_settings(
         folder: str,
         model_repo: str,
+        decoding_profile: str,
         general_thresh: float,
         general_mcut_enabled: bool,
         character_thresh: float,
@@ -325,6 +374,7 @@ def save_dataset_settings(args):
         from yadt.db_dataset import db
 
         db.set_dataset_setting(folder, "model_repo", str(model_repo))
+        db.set_dataset_setting(folder, "decoding_profile", str(decoding_profile))
         db.set_dataset_setting(folder, "general_thresh", str(general_thresh))
         db.set_dataset_setting(folder, "general_mcut_enabled", str(general_mcut_enabled))
         db.set_dataset_setting(folder, "character_thresh", str(character_thresh))
@@ -426,7 +476,7 @@ def ui(args):
                     '<p style="margin-top: -1em"><i>Dataset settings are saved on submit. Use the load button to reload them.</i></p>'
                 )
 
-                model_repo, custom_model, use_custom_model = create_model_selector()
+                model_repo, custom_model, use_custom_model, decoding_profile = create_model_selector()
 
                 (
                     general_thresh,
@@ -485,6 +535,7 @@ def ui(args):
                         components=[
                             folder,
                             model_repo,
+                            decoding_profile,
                             general_thresh,
                             general_mcut_enabled,
                             character_thresh,
@@ -560,6 +611,7 @@ def ui(args):
         inputs=[
             folder,
             model_repo,
+            decoding_profile,
             general_thresh,
             general_mcut_enabled,
             character_thresh,
@@ -634,6 +686,7 @@ def ui(args):
 
     dataset_settings = [
         model_repo,
+        decoding_profile,
         general_thresh,
         general_mcut_enabled,
         character_thresh,
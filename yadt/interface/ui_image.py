@@ -16,6 +16,7 @@ def predict(args):
         model_repo: str,
         custom_model: str,
         use_custom_model: bool,
+        decoding_profile: str,
         general_thresh: float,
         general_mcut_enabled: bool,
         character_thresh: float,
@@ -29,10 +30,12 @@ def predict(args):
         if use_custom_model:
             model_repo = custom_model
 
-        tagger_shared.predictor.load_model(model_repo, is_custom_model=use_custom_model, device=args.device)
+        tagger_shared.predictor.load_model(
+            model_repo, is_custom_model=use_custom_model, **tagger_shared.model_kwargs(args)
+        )
 
         return process_prediction.post_process_prediction(
-            *tagger_shared.predictor.predict(image),
+            *tagger_shared.predictor.predict(image, decoding_profile=decoding_profile),
             general_thresh,
             general_mcut_enabled,
             character_thresh,
@@ -50,7 +53,7 @@ def ui(args):
         with gr.Column(variant="panel"):
             image = gr.Image(type="pil", image_mode="RGBA", label="Input")
 
-            model_repo, custom_model, use_custom_model = create_model_selector()
+            model_repo, custom_model, use_custom_model, decoding_profile = create_model_selector()
 
             (
                 general_thresh,
@@ -82,6 +85,7 @@ def ui(args):
                         model_repo,
                         custom_model,
                         use_custom_model,
+                        decoding_profile,
                         general_thresh,
                         general_mcut_enabled,
                         character_thresh,
@@ -114,6 +118,7 @@ def ui(args):
             model_repo,
             custom_model,
             use_custom_model,
+            decoding_profile,
             general_thresh,
             general_mcut_enabled,
             character_thresh,
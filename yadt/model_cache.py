@@ -0,0 +1,80 @@
+import os
+import pathlib
+import threading
+
+from typing import Callable
+
+_cache_dir = pathlib.Path(__file__).parent.parent / "model_cache"
+_file_hashes_lock = threading.Lock()
+
+
+def set_cache_dir(path: str):
+    global _cache_dir
+    _cache_dir = pathlib.Path(path)
+
+
+def cache_dir() -> pathlib.Path:
+    _cache_dir.mkdir(parents=True, exist_ok=True)
+    return _cache_dir
+
+
+def file_hash(path: str) -> str:
+    """
+    Returns the sha256 of a file. Hashing a large model takes a while, so the
+    result is remembered for as long as the file's size and mtime don't change.
+    """
+    import json
+    import hashlib
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    stat_key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    hashes_path = cache_dir() / "file_hashes.json"
+
+    with _file_hashes_lock:
+        try:
+            with open(hashes_path, "r") as f:
+                hashes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            hashes = {}
+
+        if stat_key in hashes:
+            return hashes[stat_key]
+
+        hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                hash.update(chunk)
+
+        hashes[stat_key] = hash.hexdigest()
+
+        tmp_path = hashes_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(hashes, f)
+        os.replace(tmp_path, hashes_path)
+
+        return hashes[stat_key]
+
+
+def cached_file(source_path: str, variant: str, suffix: str, build: Callable[[str, str], None]) -> str:
+    """
+    Returns the path of a file derived from `source_path`, calling `build(source_path, path)`
+    to create it when it isn't cached yet. The cache key is made up of the source file's hash
+    and the variant, so a derived file is never reused for a different source or variant.
+    """
+    path = cache_dir() / f"{file_hash(source_path)}-{variant}{suffix}"
+
+    if not path.exists():
+        print(f"* Building cached {variant} model: {path}")
+
+        # Build into a temporary file first, so an interrupted build never leaves a broken cache entry
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp{suffix}")
+        try:
+            build(source_path, str(tmp_path))
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                os.unlink(tmp_path)
+
+    return str(path)
@@ -0,0 +1,340 @@
+import argparse
+import threading
+
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+GRAPH_OPTIMIZATION_LEVELS = ["disable", "basic", "extended", "all"]
+EXECUTION_MODES = ["sequential", "parallel"]
+
+# Keyword arguments (CLI flags and per-model config keys) that map onto onnxruntime.SessionOptions
+SESSION_OPTION_KEYS = [
+    "intra_op_num_threads",
+    "inter_op_num_threads",
+    "graph_optimization_level",
+    "execution_mode",
+    "enable_cpu_mem_arena",
+    "enable_mem_pattern",
+    "optimized_model_cache",
+]
+
+
+def add_session_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the onnxruntime session flags to a parser. Unset flags keep the onnxruntime defaults.
+    """
+    parser.add_argument("--intra-op-num-threads", type=int, default=None)
+    parser.add_argument("--inter-op-num-threads", type=int, default=None)
+    parser.add_argument("--graph-optimization-level", type=str, choices=GRAPH_OPTIMIZATION_LEVELS, default=None)
+    parser.add_argument("--execution-mode", type=str, choices=EXECUTION_MODES, default=None)
+    parser.add_argument("--disable-cpu-mem-arena", dest="enable_cpu_mem_arena", action="store_const", const=False)
+    parser.add_argument("--disable-mem-pattern", dest="enable_mem_pattern", action="store_const", const=False)
+    parser.add_argument(
+        "--disable-optimized-model-cache", dest="optimized_model_cache", action="store_const", const=False
+    )
+
+
+def session_kwargs(args: argparse.Namespace) -> Dict[str, Any]:
+    """Collects the session options that were set on the command line"""
+    return {key: getattr(args, key) for key in SESSION_OPTION_KEYS if getattr(args, key, None) is not None}
+
+
+def pop_session_kwargs(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Removes the session options from a predictor's load_model kwargs"""
+    return {key: kwargs.pop(key) for key in SESSION_OPTION_KEYS if key in kwargs}
+
+
+def create_session_options(
+    intra_op_num_threads: int = None,
+    inter_op_num_threads: int = None,
+    graph_optimization_level: str = None,
+    execution_mode: str = None,
+    enable_cpu_mem_arena: bool = None,
+    enable_mem_pattern: bool = None,
+):
+    import onnxruntime as rt
+
+    options = rt.SessionOptions()
+
+    if intra_op_num_threads is not None:
+        options.intra_op_num_threads = int(intra_op_num_threads)
+
+    if inter_op_num_threads is not None:
+        options.inter_op_num_threads = int(inter_op_num_threads)
+
+    if graph_optimization_level is not None:
+        assert (
+            graph_optimization_level in GRAPH_OPTIMIZATION_LEVELS
+        ), f"Unknown graph optimization level: {graph_optimization_level}"
+
+        options.graph_optimization_level = {
+            "disable": rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[graph_optimization_level]
+
+    if execution_mode is not None:
+        assert execution_mode in EXECUTION_MODES, f"Unknown execution mode: {execution_mode}"
+
+        options.execution_mode = {
+            "sequential": rt.ExecutionMode.ORT_SEQUENTIAL,
+            "parallel": rt.ExecutionMode.ORT_PARALLEL,
+        }[execution_mode]
+
+    if enable_cpu_mem_arena is not None:
+        options.enable_cpu_mem_arena = bool(enable_cpu_mem_arena)
+
+    if enable_mem_pattern is not None:
+        options.enable_mem_pattern = bool(enable_mem_pattern)
+
+    return options
+
+
+def describe_session_options(options) -> str:
+    return ", ".join(
+        [
+            f"intra_op_num_threads={options.intra_op_num_threads or 'auto'}",
+            f"inter_op_num_threads={options.inter_op_num_threads or 'auto'}",
+            f"graph_optimization_level={options.graph_optimization_level.name}",
+            f"execution_mode={options.execution_mode.name}",
+            f"enable_cpu_mem_arena={options.enable_cpu_mem_arena}",
+            f"enable_mem_pattern={options.enable_mem_pattern}",
+        ]
+    )
+
+
+def _save_optimized_model(model_path: str, optimized_model_path: str, **kwargs):
+    import onnxruntime as rt
+
+    options = create_session_options(**kwargs)
+    options.optimized_model_filepath = optimized_model_path
+    options.add_session_config_entry("session.save_model_format", "ORT")
+
+    # Creating the session runs the graph optimizations and writes the result to optimized_model_filepath
+    rt.InferenceSession(model_path, sess_options=options)
+
+
+# Instruction sets that change the graph optimizations, e.g. the block size of the NCHWc layout of ORT_ENABLE_ALL,
+# best first
+_CPU_INSTRUCTION_SETS = ["AVX512F", "AVX2", "AVX", "ASIMD", "NEON"]
+
+
+def cpu_instruction_set() -> str:
+    """Returns the best of _CPU_INSTRUCTION_SETS the CPU supports, as detected by NumPy"""
+    try:
+        from numpy._core._multiarray_umath import __cpu_features__
+    except ImportError:
+        from numpy.core._multiarray_umath import __cpu_features__
+
+    return next((name.lower() for name in _CPU_INSTRUCTION_SETS if __cpu_features__.get(name)), "generic")
+
+
+def optimized_model(model_path: str, **kwargs) -> str:
+    """
+    Returns the path to a cached copy of the model in the .ort format, with the graph optimizations
+    for the given options already applied. Some optimizations depend on the machine, its instruction set and the
+    execution providers, so those are part of the cache key alongside the model hash and onnxruntime version.
+    """
+    import platform
+    import onnxruntime as rt
+
+    from yadt import model_cache
+
+    options = create_session_options(**kwargs)
+    providers = "-".join(p.removesuffix("ExecutionProvider") for p in rt.get_available_providers())
+    level = options.graph_optimization_level.name.lower()
+    variant = f"ort{rt.__version__}-{level}-{platform.machine()}-{cpu_instruction_set()}-{providers}"
+
+    return model_cache.cached_file(
+        model_path,
+        variant,
+        ".ort",
+        lambda source_path, path: _save_optimized_model(source_path, path, **kwargs),
+    )
+
+
+def _quantize_model(model_path: str, quantized_model_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # Only the matrix multiplications are quantized, they make up most of the compute and
+    # the weights of the taggers. Integer convolutions are slower than float ones on most CPUs.
+    quantize_dynamic(
+        model_path,
+        quantized_model_path,
+        op_types_to_quantize=["MatMul", "Gemm"],
+        weight_type=QuantType.QInt8,
+    )
+
+
+def quantized_model(model_path: str) -> str:
+    """
+    Returns the path to a cached, dynamically quantized (INT8) copy of the model, building it on first use.
+    """
+    from yadt import model_cache
+
+    return model_cache.cached_file(model_path, "int8", ".onnx", _quantize_model)
+
+
+def _add_input_cast(model_path: str, cast_model_path: str):
+    import onnx
+
+    model = onnx.load(model_path)
+    graph = model.graph
+
+    model_input = graph.input[0]
+    assert (
+        model_input.type.tensor_type.elem_type == onnx.TensorProto.FLOAT
+    ), f"Model input {model_input.name} is not float32"
+
+    # The graph input becomes uint8 under the same name, and a Cast node feeds the old float32 value
+    # to every node that used to read the input
+    cast_output = f"{model_input.name}_float"
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == model_input.name:
+                node.input[i] = cast_output
+
+    graph.node.insert(0, onnx.helper.make_node("Cast", [model_input.name], [cast_output], to=onnx.TensorProto.FLOAT))
+    model_input.type.tensor_type.elem_type = onnx.TensorProto.UINT8
+
+    onnx.checker.check_model(model)
+    onnx.save(model, cast_model_path)
+
+
+def uint8_input_model(model_path: str) -> str:
+    """
+    Returns the path to a cached copy of the model that takes uint8 input and casts it to float32 in the graph,
+    so batches can be filled with decoded pixels directly, at a quarter of the memory traffic.
+    """
+    from yadt import model_cache
+
+    return model_cache.cached_file(model_path, "uint8-input", ".onnx", _add_input_cast)
+
+
+def _append_top_k(model_path: str, top_k_model_path: str, k: int, rating_indexes: List[int]):
+    import onnx
+
+    from onnx import helper, numpy_helper
+
+    model = onnx.load(model_path)
+    graph = model.graph
+
+    model_output = graph.output[0]
+    batch_dim = model_output.type.tensor_type.shape.dim[0]
+    batch_dim = batch_dim.dim_param or batch_dim.dim_value or "batch"
+
+    graph.initializer.extend(
+        [
+            numpy_helper.from_array(np.asarray(rating_indexes, dtype=np.int64), "rating_indexes"),
+            numpy_helper.from_array(np.asarray([k], dtype=np.int64), "top_k"),
+        ]
+    )
+    graph.node.extend(
+        [
+            # Ratings are always needed, so they are returned separately from the top k
+            helper.make_node("Gather", [model_output.name, "rating_indexes"], ["rating_scores"], axis=1),
+            helper.make_node(
+                "TopK", [model_output.name, "top_k"], ["top_k_scores", "top_k_indexes"], axis=-1, largest=1, sorted=1
+            ),
+        ]
+    )
+
+    del graph.output[:]
+    graph.output.extend(
+        [
+            helper.make_tensor_value_info("rating_scores", onnx.TensorProto.FLOAT, [batch_dim, len(rating_indexes)]),
+            helper.make_tensor_value_info("top_k_scores", onnx.TensorProto.FLOAT, [batch_dim, k]),
+            helper.make_tensor_value_info("top_k_indexes", onnx.TensorProto.INT64, [batch_dim, k]),
+        ]
+    )
+
+    onnx.checker.check_model(model)
+    onnx.save(model, top_k_model_path)
+
+
+def top_k_model(model_path: str, k: int, rating_indexes: List[int]) -> str:
+    """
+    Returns the path to a cached copy of the model that returns the rating scores and the `k` highest
+    scores with their tag indexes, instead of the scores of the whole vocabulary.
+    """
+    from yadt import model_cache
+
+    return model_cache.cached_file(
+        model_path,
+        f"top{k}",
+        ".onnx",
+        lambda source_path, path: _append_top_k(source_path, path, k, rating_indexes),
+    )
+
+
+def create_session(model_path: str, optimized_model_cache: bool = True, **kwargs):
+    """
+    Creates an onnxruntime.InferenceSession with the given session options, logging the values in use.
+    With `optimized_model_cache`, the optimized graph is cached on disk and loaded from there on later loads.
+    """
+    import onnxruntime as rt
+
+    options = create_session_options(**kwargs)
+    print(f"* onnxruntime session options: {describe_session_options(options)}")
+
+    if optimized_model_cache:
+        try:
+            with open(optimized_model(model_path, **kwargs), "rb") as f:
+                model_bytes = f.read()
+        except Exception as e:
+            print(f"! Could not cache the optimized model, loading {model_path} instead: {str(e)}")
+        else:
+            # Let onnxruntime use the model bytes in place instead of copying them.
+            # The session keeps a reference to the bytes for as long as it is alive.
+            options.add_session_config_entry("session.load_model_format", "ORT")
+            options.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+
+            return rt.InferenceSession(model_bytes, sess_options=options)
+
+    return rt.InferenceSession(model_path, sess_options=options)
+
+
+class BatchedSession:
+    """
+    Runs an onnxruntime.InferenceSession on preallocated batches. The input batch buffer and the output buffers
+    are allocated once for the batch size and bound through io_binding on every run, so onnxruntime neither
+    copies the input nor allocates new output arrays. The buffers are shared, so batches must hold `lock`.
+    """
+
+    def __init__(self, session, batch_size: int, input_dtype, output_shapes: List[Tuple[int, Any]]):
+        model_input = session.get_inputs()[0]
+        batch_dim = model_input.shape[0]
+
+        # Models exported with a fixed batch dimension can't take larger batches
+        if isinstance(batch_dim, int):
+            batch_size = min(batch_size, batch_dim)
+
+        self.session = session
+        self.batch_size = batch_size
+        self.input_name = model_input.name
+        self.output_names = [output.name for output in session.get_outputs()]
+        self.io_binding = session.io_binding()
+        self.lock = threading.Lock()
+
+        # Inputs are prepared straight into this buffer and the model writes its outputs straight into the
+        # output buffers, they are all reused for every batch
+        self.batch_buffer = np.empty((batch_size, *model_input.shape[1:]), dtype=input_dtype)
+        self.output_buffers = [np.empty((batch_size, size), dtype=dtype) for size, dtype in output_shapes]
+
+    def run(self, batch: np.ndarray) -> List[np.ndarray]:
+        """
+        Runs the model on a contiguous batch of up to batch_size inputs, usually from `batch_buffer`,
+        returning views of the output buffers, which are overwritten by the next run.
+        """
+        import onnxruntime as rt
+
+        outputs = [buffer[: len(batch)] for buffer in self.output_buffers]
+
+        self.io_binding.bind_cpu_input(self.input_name, batch)
+        for name, output in zip(self.output_names, outputs):
+            self.io_binding.bind_ortvalue_output(name, rt.OrtValue.ortvalue_from_numpy(output))
+        self.session.run_with_iobinding(self.io_binding)
+
+        return outputs
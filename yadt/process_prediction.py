@@ -3,6 +3,8 @@ from typing import Tuple, Dict, List
 import functools
 import numpy as np
 
+from dataclasses import dataclass
+
 # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/blob/a9eacb1eff904552d3012babfa28b57e1d3e295c/tagger/ui.py#L368
 kaomojis = {
     "0_0",
@@ -27,6 +29,53 @@ kaomojis = {
 }
 
 
+# Key of the highest score a score floor left out of a general or character dict. It is never a tag, but MCut needs
+# it to see the gap down to the scores that were left out, see post_process_prediction
+SCORE_FLOOR_TAIL = "<below score floor>"
+
+
+@dataclass
+class PredictionResult:
+    """
+    Compact prediction for a single image: the raw score vector of the model, plus the tag names and
+    per-category index arrays, which are shared between all the results of a model.
+    """
+
+    scores: np.ndarray
+    tag_names: np.ndarray
+    rating_indexes: np.ndarray
+    general_indexes: np.ndarray
+    character_indexes: np.ndarray
+
+    def _tags(self, indexes: np.ndarray, score_floor: float = None) -> Dict[str, float]:
+        scores = self.scores[indexes]
+
+        tail = None
+        if score_floor is not None:
+            passed = scores >= score_floor
+            if not passed.all():
+                tail = float(scores[~passed].max())
+            indexes, scores = indexes[passed], scores[passed]
+
+        tags = dict(zip(self.tag_names[indexes].tolist(), scores.tolist()))
+        if tail is not None:
+            tags[SCORE_FLOOR_TAIL] = tail
+
+        return tags
+
+    def to_dicts(self, score_floor: float = 0.0) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, float]]:
+        """
+        Builds the (rating, general, character) dicts used by post_process_prediction. General and
+        character tags scoring below `score_floor` are left out, ratings are always included.
+        The highest score left out of a dict is kept under SCORE_FLOOR_TAIL.
+        """
+        rating = self._tags(self.rating_indexes)
+        general_res = self._tags(self.general_indexes, score_floor)
+        character_res = self._tags(self.character_indexes, score_floor)
+
+        return rating, general_res, character_res
+
+
 @functools.lru_cache(maxsize=102400)
 def _replace_underscore_for_tag(tag):
     return tag.replace("_", " ") if tag not in kaomojis else tag
@@ -48,7 +97,7 @@ def post_process_prediction(
     ban_tags: str = None,
     map_tags: str = None,
 ):
-    def _threshold(tags: List[Tuple[str, float]], t: float, mcut: bool):
+    def _threshold(tags: List[Tuple[str, float]], t: float, mcut: bool, tail: float = None):
         def mcut_threshold(probs):
             """
             Maximum Cut Thresholding (MCut)
@@ -56,6 +105,10 @@ def post_process_prediction(
             for Multi-label Classification. In 11th International Symposium, IDA 2012
             (pp. 172-183).
             """
+            # Tags below the score floor aren't predicted, so there may be no gap to cut at
+            if len(probs) < 2:
+                return probs[0] if len(probs) > 0 else 0
+
             sorted_probs = probs[probs.argsort()[::-1]]
             difs = sorted_probs[:-1] - sorted_probs[1:]
             t = difs.argmax()
@@ -63,7 +116,8 @@ def post_process_prediction(
             return thresh
 
         if mcut:
-            probs = np.array([x[1] for x in tags])
+            # The highest score below the score floor stands in for the scores that were left out
+            probs = np.array([x[1] for x in tags] + ([tail] if tail is not None else []))
             t = max(t, mcut_threshold(probs))
 
         return [x for x in tags if x[1] >= t]
@@ -273,14 +327,19 @@ def post_process_prediction(
     # print('character_res', len(character_res.items()), len(_replace_underscore(_threshold(character_res.items(), character_thresh, character_mcut_enabled))))
     # print('general_res', len(general_res.items()), len(_replace_underscore(_threshold(general_res.items(), general_thresh, general_mcut_enabled))))
 
+    character_res, character_tail = dict(character_res), character_res.get(SCORE_FLOOR_TAIL)
+    general_res, general_tail = dict(general_res), general_res.get(SCORE_FLOOR_TAIL)
+    character_res.pop(SCORE_FLOOR_TAIL, None)
+    general_res.pop(SCORE_FLOOR_TAIL, None)
+
     character_res = _replace_underscore(character_res.items())
     general_res = _replace_underscore(general_res.items())
 
     character_tags = set([k for k, _ in character_res])
     general_tags = set([k for k, _ in general_res])
 
-    character_res = _threshold(character_res, character_thresh, character_mcut_enabled)
-    general_res = _trim_general_tag_dupes(_threshold(general_res, general_thresh, general_mcut_enabled))
+    character_res = _threshold(character_res, character_thresh, character_mcut_enabled, character_tail)
+    general_res = _trim_general_tag_dupes(_threshold(general_res, general_thresh, general_mcut_enabled, general_tail))
 
     tag_string = _generate_string(character_res, general_res)
 
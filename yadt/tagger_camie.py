@@ -1,15 +1,31 @@
+from typing import List
 import huggingface_hub
+import numpy as np
 from PIL import Image
 
+from yadt import process_prediction
+
 MODEL_REPO_PREFIX = "Camais03/"
 
 CAMIE_MODEL_FULL = "Camais03/camie-tagger"
 CAMIE_MODEL_INITIAL_ONLY = "Camais03/camie-tagger (low vram/initial only)"
 
+# Suffix for the dynamically quantized variant of a model, e.g. "Camais03/camie-tagger (int8)"
+INT8_VARIANT_SUFFIX = " (int8)"
+
+DEFAULT_BATCH_SIZE = 8
+
+# "torch" runs the models in PyTorch, "onnx" runs their ONNX export on onnxruntime
+BACKENDS = ["torch", "onnx"]
+
 
 class Predictor:
     def __init__(self):
         self.model = None
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.preprocessor = None
+        self.category_thresholds = None
+        self.tag_thresholds = None
 
     def download_model(self, model_repo, full_model: bool):
         import os
@@ -65,9 +81,46 @@ class Predictor:
 
             return metadata_path, model_info_path, state_dict_path
 
+    def download_thresholds(self, model_repo, full_model: bool = True):
+        """
+        Returns the path to the thresholds.json of the model, or None. The thresholds of the full model are tuned for
+        its refined predictions, so the initial-only model only falls back to them without thresholds of its own.
+        """
+        import os
+
+        from huggingface_hub.utils import EntryNotFoundError
+
+        filenames = (
+            ["model/thresholds.json"] if full_model else ["model/thresholds_initial.json", "model/thresholds.json"]
+        )
+
+        for filename in filenames:
+            if os.path.isdir(model_repo):
+                thresholds_path = os.path.join(model_repo, filename)
+                if not os.path.exists(thresholds_path):
+                    continue
+            else:
+                try:
+                    thresholds_path = huggingface_hub.hf_hub_download(CAMIE_MODEL_FULL, filename)
+                except EntryNotFoundError:
+                    continue
+                except Exception as e:
+                    print(f"! Could not download {os.path.basename(filename)}: {str(e)}")
+                    return None
+
+            if filename != filenames[0]:
+                print("! No thresholds for the initial-only model, using the thresholds of the full model")
+
+            return thresholds_path
+
+        return None
+
     def load_model(self, model_repo: str, **kwargs):
         import os
 
+        quantized = model_repo.endswith(INT8_VARIANT_SUFFIX)
+        model_repo = model_repo.removesuffix(INT8_VARIANT_SUFFIX)
+
         # Check if it's a local path or a known model name
         if os.path.isdir(model_repo):
             # For local path, determine model type
@@ -80,23 +133,165 @@ class Predictor:
 
         device = kwargs.pop("device", "cpu")
 
-        from yadt.tagger_camie_model import load_model
+        batch_size = int(kwargs.pop("batch_size", DEFAULT_BATCH_SIZE))
+        assert batch_size > 0, "Batch size must be at least 1"
+        self.batch_size = batch_size
 
-        self.model, _, _ = load_model(
-            ".",
-            full=full_model,
-            metadata_path=metadata_path,
-            model_info_path=model_info_path,
-            state_dict_path=state_dict_path,
-            device=device,
-        )
+        precision = kwargs.pop("precision", None)
+        preprocess_workers = kwargs.pop("preprocess_workers", None)
 
-    def predict(self, image: Image):
+        # How many of the top initial predictions the refinement stage attends to, the model's own if unset
+        tag_context_size = kwargs.pop("tag_context_size", None)
+        if tag_context_size is not None:
+            tag_context_size = int(tag_context_size)
+
+        # Only refine the images with tags close to their thresholds, see tagger_camie_model.run_cascade
+        cascade_band = kwargs.pop("cascade_band", None)
+        if cascade_band is not None:
+            cascade_band = float(cascade_band)
+            assert 0 < cascade_band < 1, "Cascade band must be between 0 and 1"
+        torch_compile = bool(kwargs.pop("torch_compile", False))
+
+        backend = kwargs.pop("backend", None) or "torch"
+        assert backend in BACKENDS, f"Unknown backend: {backend}, expected one of {', '.join(BACKENDS)}"
+
+        # The INT8 variants quantize the Linear layers of the ONNX export, so they always run on onnxruntime
+        if quantized and backend != "onnx":
+            print(f"* Running the INT8 variant on the onnx backend instead of {backend}")
+            backend = "onnx"
+
+        # Optionally filter the predictions with the category and per-tag thresholds of a thresholds.json profile
+        threshold_profile = kwargs.pop("threshold_profile", None)
+        thresholds_path = self.download_thresholds(model_repo, full_model) if threshold_profile else None
+
+        if backend == "onnx":
+            import json
+
+            from yadt.tagger_camie_dataset import load_tag_dataset
+            from yadt.tagger_camie_onnx import OnnxImageTagger, exported_model
+
+            if cascade_band:
+                print("! The cascade is only supported by the torch backend, refining every image")
+
+            onnx_path = exported_model(state_dict_path, full_model, metadata_path, model_info_path, tag_context_size)
+            if quantized:
+                from yadt import onnx_session
+
+                onnx_path = onnx_session.quantized_model(onnx_path)
+
+            self.model = OnnxImageTagger(onnx_path, load_tag_dataset(metadata_path), batch_size, **kwargs)
+
+            thresholds = None
+            if thresholds_path:
+                with open(thresholds_path, "r") as f:
+                    thresholds = json.load(f)
+        else:
+            from yadt.tagger_camie_model import load_model, set_tag_context_size
+
+            self.model, _, thresholds = load_model(
+                ".",
+                full=full_model,
+                metadata_path=metadata_path,
+                model_info_path=model_info_path,
+                state_dict_path=state_dict_path,
+                thresholds_path=thresholds_path,
+                device=device,
+                precision=precision,
+            )
+
+            set_tag_context_size(self.model, tag_context_size)
+
+        self.category_thresholds, self.tag_thresholds = None, None
+        if threshold_profile:
+            if thresholds:
+                from yadt.tagger_camie_dataset import thresholds_for_profile
+
+                self.category_thresholds, self.tag_thresholds = thresholds_for_profile(thresholds, threshold_profile)
+            else:
+                print(f"! No thresholds.json found, not applying the {threshold_profile} thresholds")
+
+        if backend == "torch":
+            from yadt.tagger_camie_model import compile_model, set_cascade
+
+            # The cascade looks for tags close to the thresholds of the profile, not to the score floor
+            set_cascade(
+                self.model,
+                cascade_band,
+                category_thresholds=self.category_thresholds,
+                tag_thresholds=self.tag_thresholds,
+            )
+
+            if torch_compile and self.model.cascade_band:
+                print("! The cascade runs eagerly, not compiling the Camie model")
+            elif torch_compile:
+                compile_model(self.model, batch_size)
+
+        from yadt.tagger_camie_preprocess import Preprocessor
+
+        # Images are preprocessed on worker threads, while the model runs the previous batch
+        self.close()
+        self.preprocessor = Preprocessor(batch_size, num_workers=preprocess_workers)
+
+    def close(self):
+        """Stops the preprocessing workers of the previously loaded model"""
+        if self.preprocessor is not None:
+            self.preprocessor.shutdown()
+            self.preprocessor = None
+
+    def predict_batch(self, images: List[Image.Image], batch_size: int = None, score_floor: float = 0.0):
+        """
+        Predicts a list of images, running up to `batch_size` images per forward pass.
+        Returns (rating, general, character) dicts for each image, leaving out tags scoring below `score_floor`
+        (or the thresholds of the profile), the highest score left out is kept under SCORE_FLOOR_TAIL.
+        """
         assert self.model is not None, "No model loaded"
 
-        results = self.model.predict(image)
-        tags = self.model.get_tags_from_predictions(
-            results["predictions"], probabilities=results["refined_probabilities"]
-        )
+        # Compiled models are compiled for batches of self.batch_size
+        batch_size = min(batch_size or self.batch_size, self.batch_size)
+
+        cascade_stats = dict(getattr(self.model, "cascade_stats", None) or {})
+
+        predictions = []
+        for batch in self.preprocessor.batches(images, batch_size):
+            results = self.model.predict_preprocessed(
+                batch,
+                threshold=score_floor,
+                category_thresholds=self.category_thresholds,
+                tag_thresholds=self.tag_thresholds,
+            )
+            batch_tags = self.model.get_tags_from_predictions_batch(
+                results["predictions"], probabilities=results["refined_probabilities"]
+            )
+            tails = self._tail_scores(results)
+
+            for i, tags in enumerate(batch_tags):
+                general, character = dict(tags.get("general", [])), dict(tags.get("character", []))
+                for category, category_tags in (("general", general), ("character", character)):
+                    if tails[category][i] > -np.inf:
+                        category_tags[process_prediction.SCORE_FLOOR_TAIL] = float(tails[category][i])
 
-        return dict(tags["rating"]), dict(tags["general"]), dict(tags["character"])
+                predictions.append((dict(tags.get("rating", [])), general, character))
+
+        if getattr(self.model, "cascade_band", None):
+            stats = self.model.cascade_stats
+            refined, total = stats["refined"] - cascade_stats["refined"], stats["images"] - cascade_stats["images"]
+            print(f"* Cascade refined {refined} of {total} images")
+
+        return predictions
+
+    def _tail_scores(self, results):
+        """
+        The highest score of the general and character tags left out by the thresholds, for every image of a batch,
+        see process_prediction.SCORE_FLOOR_TAIL
+        """
+        probabilities, predictions = results["refined_probabilities"], results["predictions"]
+        if hasattr(probabilities, "cpu"):
+            probabilities, predictions = probabilities.float().cpu().numpy(), predictions.cpu().numpy()
+
+        return {
+            category: self.model.dataset.tail_scores(probabilities, predictions > 0, category)
+            for category in ("general", "character")
+        }
+
+    def predict(self, image: Image):
+        return self.predict_batch([image])[0]
@@ -0,0 +1,184 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Category of tags without an entry in metadata.json
+DEFAULT_CATEGORY = "general"
+
+
+class TagDataset:
+    """
+    Lightweight dataset wrapper for inference only.
+    Tags are stored as a names array and integer category codes indexing into `category_names`.
+    """
+
+    def __init__(self, tag_names: np.ndarray, category_codes: np.ndarray, category_names: List[str]):
+        self.tag_names = tag_names
+        self.category_codes = category_codes
+        self.category_names = list(category_names)
+        self._tag_to_idx = None
+
+    @classmethod
+    def from_metadata(cls, total_tags: int, idx_to_tag: Dict[str, str], tag_to_category: Dict[str, str]):
+        idx_to_tag = {int(k): v for k, v in idx_to_tag.items()}
+        tag_names = [idx_to_tag.get(idx, f"unknown-{idx}") for idx in range(total_tags)]
+        categories = [tag_to_category.get(tag_name, DEFAULT_CATEGORY) for tag_name in tag_names]
+
+        category_names = list(dict.fromkeys([DEFAULT_CATEGORY, *categories]))
+        category_lookup = {category: code for code, category in enumerate(category_names)}
+
+        return cls(
+            tag_names=np.array(tag_names, dtype=object),
+            category_codes=np.array([category_lookup[category] for category in categories], dtype=np.int16),
+            category_names=category_names,
+        )
+
+    @property
+    def total_tags(self) -> int:
+        return len(self.tag_names)
+
+    def get_tag_info(self, idx) -> Tuple[str, str]:
+        """Get tag name and category for a given index"""
+        return self.tag_names[idx], self.category_names[self.category_codes[idx]]
+
+    def get_tag_index(self, tag_name) -> Optional[int]:
+        """Get the index of a tag name, or None for unknown tags"""
+        if self._tag_to_idx is None:
+            self._tag_to_idx = {tag_name: idx for idx, tag_name in enumerate(self.tag_names.tolist())}
+
+        return self._tag_to_idx.get(tag_name)
+
+    def threshold_vector(
+        self,
+        threshold: float = 0,
+        category_thresholds: Optional[Dict[str, float]] = None,
+        tag_thresholds: Optional[Dict[str, float]] = None,
+    ) -> np.ndarray:
+        """
+        Returns a float32 vector with the threshold of every tag.
+        Tags take their per-tag threshold if there is one, otherwise the threshold of their category. With category
+        thresholds, tags in other categories are never predicted, without them they use `threshold`.
+        """
+        default = np.inf if category_thresholds else threshold
+        threshold_vector = np.full(self.total_tags, default, dtype=np.float32)
+
+        for category, cat_threshold in (category_thresholds or {}).items():
+            if category in self.category_names:
+                threshold_vector[self.category_codes == self.category_names.index(category)] = cat_threshold
+
+        for tag_name, tag_threshold in (tag_thresholds or {}).items():
+            idx = self.get_tag_index(tag_name)
+            if idx is not None:
+                threshold_vector[idx] = tag_threshold
+
+        return threshold_vector
+
+    def tail_scores(self, probabilities: np.ndarray, predictions: np.ndarray, category: str) -> np.ndarray:
+        """
+        Returns the highest probability of the tags of `category` that weren't predicted, one per image.
+        Images without such a tag get -inf.
+        """
+        if category not in self.category_names:
+            return np.full(len(probabilities), -np.inf, dtype=np.float32)
+
+        mask = self.category_codes == self.category_names.index(category)
+        return np.where(predictions[:, mask], -np.inf, probabilities[:, mask]).max(axis=1, initial=-np.inf)
+
+    def group_tags(
+        self,
+        batch_size: int,
+        image_indices: np.ndarray,
+        tag_indices: np.ndarray,
+        probabilities: Optional[np.ndarray] = None,
+    ) -> List[Dict[str, list]]:
+        """
+        Groups the positive predictions of a batch, given as (image, tag) index pairs, into one dict per image that
+        maps categories to tag names, or to (tag name, probability) pairs sorted by descending probability.
+        Sorting and grouping is done with NumPy, so Python only runs once per image and category.
+        """
+        category_codes = self.category_codes[tag_indices]
+
+        # Sort by image, then category, then descending probability, and tag index for ties
+        if probabilities is not None:
+            order = np.lexsort((tag_indices, -probabilities, category_codes, image_indices))
+        else:
+            order = np.lexsort((tag_indices, category_codes, image_indices))
+
+        image_indices, tag_indices, category_codes = image_indices[order], tag_indices[order], category_codes[order]
+
+        names = self.tag_names[tag_indices].tolist()
+        if probabilities is not None:
+            names = list(zip(names, probabilities[order].tolist()))
+
+        # Split into runs of the same image and category
+        starts = np.flatnonzero(
+            np.diff(image_indices, prepend=-1, append=-1) | np.diff(category_codes, prepend=-1, append=-1)
+        )
+
+        results = [{} for _ in range(batch_size)]
+        for start, end in zip(starts[:-1].tolist(), starts[1:].tolist()):
+            category = self.category_names[category_codes[start]]
+            results[image_indices[start]][category] = names[start:end]
+
+        return results
+
+
+def thresholds_for_profile(thresholds, profile="balanced"):
+    """
+    Reads the category and per-tag thresholds of a profile (e.g. "balanced") from the contents of thresholds.json.
+    Per-tag thresholds live in an optional "tags" section, either as a number or per profile like the categories.
+    """
+
+    def profile_threshold(value):
+        if isinstance(value, dict):
+            value = value.get(profile)
+            return value["threshold"] if isinstance(value, dict) else value
+        return value
+
+    category_thresholds = {
+        category: profile_threshold(options) for category, options in thresholds.get("categories", {}).items()
+    }
+    tag_thresholds = {tag_name: profile_threshold(options) for tag_name, options in thresholds.get("tags", {}).items()}
+
+    return (
+        {category: value for category, value in category_thresholds.items() if value is not None},
+        {tag_name: value for tag_name, value in tag_thresholds.items() if value is not None},
+    )
+
+
+def _build_tag_cache(metadata_path: str, cache_path: str):
+    import json
+
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+
+    dataset = TagDataset.from_metadata(
+        total_tags=metadata["total_tags"],
+        idx_to_tag=metadata["idx_to_tag"],
+        tag_to_category=metadata["tag_to_category"],
+    )
+
+    with open(cache_path, "wb") as f:
+        np.savez(
+            f,
+            tag_names=dataset.tag_names.astype(str),
+            category_codes=dataset.category_codes,
+            category_names=np.array(dataset.category_names, dtype=str),
+        )
+
+
+def load_tag_dataset(metadata_path: str) -> TagDataset:
+    """
+    Loads the tags of a metadata.json. The JSON is parsed once into a binary cache, later loads read that instead.
+    """
+    from yadt import model_cache
+
+    cache_path = model_cache.cached_file(metadata_path, "tags", ".npz", _build_tag_cache)
+
+    with np.load(cache_path, allow_pickle=False) as tags:
+        return TagDataset(
+            # Object array, so looking up names reuses the strings instead of creating new ones
+            tag_names=tags["tag_names"].astype(object),
+            category_codes=tags["category_codes"],
+            category_names=tags["category_names"].tolist(),
+        )
@@ -5,9 +5,12 @@ from torchvision.models import efficientnet_v2_l, EfficientNet_V2_L_Weights
 from PIL import Image
 from typing import Optional
 import torchvision.transforms as transforms
+import contextlib
 import os
 import json
 
+from yadt.tagger_camie_dataset import TagDataset, load_tag_dataset, thresholds_for_profile
+
 
 class InitialOnlyImageTagger(nn.Module):
     """
@@ -118,12 +121,30 @@ class InitialOnlyImageTagger(nn.Module):
         # For API compatibility with the full model, return the same predictions twice
         return initial_preds, initial_preds
 
-    def predict(self, image_path, threshold=0, category_thresholds=None):
+    def predict(self, image_path, threshold=0, category_thresholds=None, tag_thresholds=None):
         """
         Run inference on an image with support for category-specific thresholds.
         """
-        # Preprocess the image
-        img_tensor = self.preprocess_image(image_path).unsqueeze(0)
+        return self.predict_batch(
+            [image_path], threshold=threshold, category_thresholds=category_thresholds, tag_thresholds=tag_thresholds
+        )
+
+    def predict_batch(self, images, threshold=0, category_thresholds=None, tag_thresholds=None):
+        """
+        Run inference on a list of images in a single forward pass, with support for category-specific
+        and per-tag thresholds. The returned tensors have one row per image.
+        """
+        # Preprocess the images
+        img_tensor = torch.stack([self.preprocess_image(image) for image in images])
+
+        return self.predict_preprocessed(img_tensor, threshold, category_thresholds, tag_thresholds)
+
+    def predict_preprocessed(self, img_tensor, threshold=0, category_thresholds=None, tag_thresholds=None):
+        """
+        Like predict_batch, for a batch that is already preprocessed, e.g. by tagger_camie_preprocess.Preprocessor.
+        Takes a (batch, 3, height, width) float32 tensor or NumPy array.
+        """
+        img_tensor = torch.as_tensor(img_tensor)
 
         # Move to the same device as model and convert to half precision
         device = next(self.parameters()).device
@@ -131,36 +152,20 @@ class InitialOnlyImageTagger(nn.Module):
         img_tensor = img_tensor.to(device, dtype=dtype)
 
         # Run inference
-        with torch.no_grad():
-            initial_preds, _ = self.forward(img_tensor)
+        initial_preds, _ = run_forward(self, img_tensor)
 
-            # Apply sigmoid to get probabilities
-            initial_probs = torch.sigmoid(initial_preds)
+        with torch.no_grad():
+            # Apply sigmoid to get probabilities, always in full precision
+            initial_probs = torch.sigmoid(initial_preds.float())
+            dtype = initial_probs.dtype
 
             # Apply thresholds
-            if category_thresholds:
-                # Create binary prediction tensors
-                initial_binary = torch.zeros_like(initial_probs)
-
-                # Apply thresholds by category
-                for category, cat_threshold in category_thresholds.items():
-                    # Create a mask for tags in this category
-                    category_mask = torch.zeros_like(initial_probs, dtype=torch.bool)
-
-                    # Find indices for this category
-                    for tag_idx in range(initial_probs.size(-1)):
-                        try:
-                            _, tag_category = self.dataset.get_tag_info(tag_idx)
-                            if tag_category == category:
-                                category_mask[:, tag_idx] = True
-                        except:
-                            continue
-
-                    # Apply threshold only to tags in this category
-                    cat_threshold_tensor = torch.tensor(cat_threshold, device=device, dtype=dtype)
-                    initial_binary[category_mask] = (initial_probs[category_mask] >= cat_threshold_tensor).to(dtype)
-
-                predictions = initial_binary
+            if category_thresholds or tag_thresholds:
+                # Compare against a per-tag threshold vector
+                threshold_vector = get_threshold_vector(
+                    self, threshold, category_thresholds, tag_thresholds, device=device, dtype=dtype
+                )
+                predictions = (initial_probs >= threshold_vector).to(dtype)
             else:
                 # Use the same threshold for all tags
                 threshold_tensor = torch.tensor(threshold, device=device, dtype=dtype)
@@ -179,34 +184,17 @@ class InitialOnlyImageTagger(nn.Module):
         """
         # Get non-zero predictions
         if predictions.dim() > 1:
-            predictions = predictions[0]  # Remove batch dimension
-
+            predictions = predictions[:1]  # Only the first image of a batch
         if probabilities is not None and probabilities.dim() > 1:
-            probabilities = probabilities[0]  # Remove batch dimension
-
-        # Get indices of positive predictions
-        indices = torch.where(predictions > 0)[0].cpu().tolist()
-
-        # Group by category
-        result = {}
-        for idx in indices:
-            tag_name, category = self.dataset.get_tag_info(idx)
-
-            if category not in result:
-                result[category] = []
-
-            if probabilities is not None:
-                prob = probabilities[idx].item()
-                result[category].append((tag_name, prob))
-            else:
-                result[category].append(tag_name)
+            probabilities = probabilities[:1]
 
-        # Sort tags by probability within each category
-        if probabilities is not None:
-            for category in result:
-                result[category] = sorted(result[category], key=lambda x: x[1], reverse=True)
+        return self.get_tags_from_predictions_batch(predictions, probabilities)[0]
 
-        return result
+    def get_tags_from_predictions_batch(self, predictions, probabilities=None):
+        """
+        Convert a batch of model predictions to human-readable tags grouped by category, one dict per image.
+        """
+        return get_tags_from_predictions_batch(self.dataset, predictions, probabilities)
 
 
 # class FlashAttentionCPU(nn.MultiheadAttention):
@@ -363,6 +351,24 @@ class FlashAttention(nn.Module):
 
         return output
 
+    def forward_single_query(self, query: torch.Tensor, key: torch.Tensor) -> torch.Tensor:
+        """
+        Inference-only equivalent of forward(query.unsqueeze(1).expand(-1, key.size(1), -1), key) for a
+        [B, D] query, which is also the value. Every query and value row would be the same, so they are
+        projected once and broadcast over the key rows, instead of projecting key.size(1) copies.
+        """
+        batch_size, seq_len = key.size(0), key.size(1)
+
+        q = self.q_proj(query).view(batch_size, 1, self.num_heads, self.head_dim).expand(-1, seq_len, -1, -1)
+        v = self.v_proj(query).view(batch_size, 1, self.num_heads, self.head_dim).expand(-1, seq_len, -1, -1)
+        k = self.k_proj(key).view(batch_size, seq_len, self.num_heads, self.head_dim)
+
+        # Same [B, S, H, D] layout as forward, where each row attends over the heads of its key
+        output = F.scaled_dot_product_attention(q, k, v, scale=self.scale, is_causal=False)
+        output = output.reshape(batch_size, seq_len, self.dim)
+
+        return self.out_proj(output)
+
 
 class FlashAttentionCPU(FlashAttention):
     def __init__(self, dim, num_heads=8, dropout=0.1, batch_first=True):
@@ -566,21 +572,6 @@ class OptimizedTagEmbedding(nn.Module):
         return tag_context, attended
 
 
-class TagDataset:
-    """Lightweight dataset wrapper for inference only"""
-
-    def __init__(self, total_tags, idx_to_tag, tag_to_category):
-        self.total_tags = total_tags
-        self.idx_to_tag = {int(k): v for k, v in idx_to_tag.items()}
-        self.tag_to_category = tag_to_category
-
-    def get_tag_info(self, idx):
-        """Get tag name and category for a given index"""
-        tag_name = self.idx_to_tag.get(idx, f"unknown-{idx}")
-        category = self.tag_to_category.get(tag_name, "general")
-        return tag_name, category
-
-
 class ImageTagger(nn.Module):
     def __init__(
         self,
@@ -655,6 +646,9 @@ class ImageTagger(nn.Module):
         # Temperature scaling
         self.temperature = nn.Parameter(torch.ones(1) * 1.5)
 
+        # At inference, the cross-attention projects its single query once, see FlashAttention.forward_single_query
+        self.single_query_cross_attention = True
+
     def _get_selected_tags(self, logits):
         """Select top-K tags based on prediction confidence"""
         # Apply sigmoid to get probabilities
@@ -730,6 +724,14 @@ class ImageTagger(nn.Module):
         model_stats = {} if self.model_stats else {}
         debug_tensors = {} if self.debug else None
 
+        features, initial_preds = self.forward_initial(x)
+        refined_preds = self.forward_refined(features, initial_preds)
+
+        # Return both prediction sets
+        return initial_preds, refined_preds
+
+    def forward_initial(self, x):
+        """The image features and the initial predictions, the first stage of forward"""
         # 1. Image Feature Extraction
         features = self.backbone.features(x)
         features = self.spatial_pool(features).squeeze(-1).squeeze(-1)
@@ -738,6 +740,10 @@ class ImageTagger(nn.Module):
         initial_logits = self.initial_classifier(features)
         initial_preds = torch.clamp(initial_logits / self.temperature, min=-15.0, max=15.0)
 
+        return features, initial_preds
+
+    def forward_refined(self, features, initial_preds):
+        """The refined predictions from the outputs of forward_initial, the second stage of forward"""
         # 3. Tag Selection & Embedding (simplified)
         pred_tag_indices, _ = self._get_selected_tags(initial_preds)
         tag_embeddings = self.tag_embedding(pred_tag_indices)
@@ -748,9 +754,14 @@ class ImageTagger(nn.Module):
 
         # 5. Cross-Attention between Features and Tags
         features_proj = self.cross_proj(features)
-        features_expanded = features_proj.unsqueeze(1).expand(-1, self.tag_context_size, -1)
 
-        cross_attended = self.cross_attention(features_expanded, attended_tags)
+        if self.single_query_cross_attention and not self.training:
+            # The same query for every tag, projected once instead of tag_context_size times
+            cross_attended = self.cross_attention.forward_single_query(features_proj, attended_tags)
+        else:
+            features_expanded = features_proj.unsqueeze(1).expand(-1, self.tag_context_size, -1)
+            cross_attended = self.cross_attention(features_expanded, attended_tags)
+
         cross_attended = self.cross_norm(cross_attended)
 
         # 6. Feature Fusion with Residual Connection
@@ -762,57 +773,61 @@ class ImageTagger(nn.Module):
         refined_logits = self.refined_classifier(combined_features)
         refined_preds = torch.clamp(refined_logits / self.temperature, min=-15.0, max=15.0)
 
-        # Return both prediction sets
-        return initial_preds, refined_preds
+        return refined_preds
 
-    def predict(self, image_path, threshold=0, category_thresholds=None):
+    def predict(self, image_path, threshold=0, category_thresholds=None, tag_thresholds=None):
         """
         Run inference on an image with support for category-specific thresholds.
         """
-        # Preprocess the image
-        img_tensor = self.preprocess_image(image_path).unsqueeze(0)
+        return self.predict_batch(
+            [image_path], threshold=threshold, category_thresholds=category_thresholds, tag_thresholds=tag_thresholds
+        )
+
+    def predict_batch(self, images, threshold=0, category_thresholds=None, tag_thresholds=None):
+        """
+        Run inference on a list of images in a single forward pass, with support for category-specific
+        and per-tag thresholds. The returned tensors have one row per image.
+        """
+        # Preprocess the images
+        img_tensor = torch.stack([self.preprocess_image(image) for image in images])
+
+        return self.predict_preprocessed(img_tensor, threshold, category_thresholds, tag_thresholds)
+
+    def predict_preprocessed(self, img_tensor, threshold=0, category_thresholds=None, tag_thresholds=None):
+        """
+        Like predict_batch, for a batch that is already preprocessed, e.g. by tagger_camie_preprocess.Preprocessor.
+        Takes a (batch, 3, height, width) float32 tensor or NumPy array.
+        """
+        img_tensor = torch.as_tensor(img_tensor)
 
         # Move to the same device as model and convert to half precision
         device = next(self.parameters()).device
         dtype = next(self.parameters()).dtype  # Match model's precision
         img_tensor = img_tensor.to(device, dtype=dtype)
 
-        # Run inference
-        with torch.no_grad():
-            initial_preds, refined_preds = self.forward(img_tensor)
+        # Probabilities are always in full precision
+        if category_thresholds or tag_thresholds:
+            # Compare against a per-tag threshold vector
+            thresholds = get_threshold_vector(
+                self, threshold, category_thresholds, tag_thresholds, device=device, dtype=torch.float32
+            )
+        else:
+            # Use the same threshold for all tags
+            thresholds = torch.tensor(threshold, device=device, dtype=torch.float32)
 
-            # Apply sigmoid to get probabilities
-            initial_probs = torch.sigmoid(initial_preds)
-            refined_probs = torch.sigmoid(refined_preds)
+        # Run inference, in cascade mode only the images with uncertain initial predictions are refined
+        if getattr(self, "cascade_band", None):
+            initial_preds, refined_preds = run_cascade(self, img_tensor)
+        else:
+            initial_preds, refined_preds = run_forward(self, img_tensor)
+
+        with torch.no_grad():
+            # Apply sigmoid to get probabilities, always in full precision
+            initial_probs = torch.sigmoid(initial_preds.float())
+            refined_probs = torch.sigmoid(refined_preds.float())
 
             # Apply thresholds
-            if category_thresholds:
-                # Create binary prediction tensors
-                refined_binary = torch.zeros_like(refined_probs)
-
-                # Apply thresholds by category
-                for category, cat_threshold in category_thresholds.items():
-                    # Create a mask for tags in this category
-                    category_mask = torch.zeros_like(refined_probs, dtype=torch.bool)
-
-                    # Find indices for this category
-                    for tag_idx in range(refined_probs.size(-1)):
-                        try:
-                            _, tag_category = self.dataset.get_tag_info(tag_idx)
-                            if tag_category == category:
-                                category_mask[:, tag_idx] = True
-                        except:
-                            continue
-
-                    # Apply threshold only to tags in this category - ensure dtype consistency
-                    cat_threshold_tensor = torch.tensor(cat_threshold, device=device, dtype=dtype)
-                    refined_binary[category_mask] = (refined_probs[category_mask] >= cat_threshold_tensor).to(dtype)
-
-                predictions = refined_binary
-            else:
-                # Use the same threshold for all tags
-                threshold_tensor = torch.tensor(threshold, device=device, dtype=dtype)
-                predictions = (refined_probs >= threshold_tensor).to(dtype)
+            predictions = (refined_probs >= thresholds).to(refined_probs.dtype)
 
             # Return both probabilities and thresholded predictions
             return {
@@ -827,52 +842,304 @@ class ImageTagger(nn.Module):
         """
         # Get non-zero predictions
         if predictions.dim() > 1:
-            predictions = predictions[0]  # Remove batch dimension
-
+            predictions = predictions[:1]  # Only the first image of a batch
         if probabilities is not None and probabilities.dim() > 1:
-            probabilities = probabilities[0]  # Remove batch dimension
+            probabilities = probabilities[:1]
 
-        # Get indices of positive predictions
-        indices = torch.where(predictions > 0)[0].cpu().tolist()
+        return self.get_tags_from_predictions_batch(predictions, probabilities)[0]
 
-        # Group by category
-        result = {}
-        for idx in indices:
-            tag_name, category = self.dataset.get_tag_info(idx)
+    def get_tags_from_predictions_batch(self, predictions, probabilities=None):
+        """
+        Convert a batch of model predictions to human-readable tags grouped by category, one dict per image.
+        """
+        return get_tags_from_predictions_batch(self.dataset, predictions, probabilities)
 
-            if category not in result:
-                result[category] = []
 
-            if probabilities is not None:
-                prob = probabilities[idx].item()
-                result[category].append((tag_name, prob))
-            else:
-                result[category].append(tag_name)
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+# Decision threshold of the cascade without a threshold profile, the default general threshold of the UI
+DEFAULT_CASCADE_THRESHOLD = 0.35
+
+
+def _autocast_supported(device_type, dtype):
+    try:
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            return F.linear(torch.ones(1, 1, device=device_type), torch.ones(1, 1, device=device_type)).dtype == dtype
+    except Exception:
+        return False
+
+
+def set_precision(model, precision="fp32"):
+    """
+    Selects the precision the model runs in:
+    - fp32: full precision
+    - bf16: bfloat16 autocast, the weights stay in full precision
+    - fp16: half precision weights on CUDA, float16 autocast on other devices where supported
+    Unsupported modes fall back to fp32 with a warning.
+    """
+    assert precision in PRECISIONS, f"Unknown precision: {precision}, expected one of {', '.join(PRECISIONS)}"
+
+    device = next(model.parameters()).device
+    model.float()
+    model.autocast_dtype = None
+
+    if precision == "fp16" and device.type == "cuda":
+        model.half()
+    elif precision != "fp32":
+        dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+
+        if _autocast_supported(device.type, dtype):
+            model.autocast_dtype = dtype
+        else:
+            print(f"! {precision} is not supported on {device}, using fp32")
+            precision = "fp32"
+
+    model.precision = precision
+    return model
+
+
+def autocast(model):
+    """Autocast context for the forward pass of a model, if its precision uses autocast"""
+    autocast_dtype = getattr(model, "autocast_dtype", None)
+    if autocast_dtype is None:
+        return contextlib.nullcontext()
+
+    return torch.autocast(device_type=next(model.parameters()).device.type, dtype=autocast_dtype)
+
+
+def run_forward(model, img_tensor):
+    """
+    Runs the forward pass of a model in its precision, through the compiled path if the model has one.
+    Partial batches are padded to the compiled batch size, so the compiled graph is reused for every batch.
+    """
+    compiled_forward = getattr(model, "compiled_forward", None)
+    if compiled_forward is None:
+        with torch.no_grad(), autocast(model):
+            return model.forward(img_tensor)
+
+    batch_size = img_tensor.size(0)
+    if batch_size < model.compiled_batch_size:
+        padding = img_tensor.new_zeros(model.compiled_batch_size - batch_size, *img_tensor.shape[1:])
+        img_tensor = torch.cat([img_tensor, padding])
+
+    img_tensor = img_tensor.contiguous(memory_format=torch.channels_last)
 
-        # Sort tags by probability within each category
-        if probabilities is not None:
-            for category in result:
-                result[category] = sorted(result[category], key=lambda x: x[1], reverse=True)
+    with torch.inference_mode(), autocast(model):
+        outputs = compiled_forward(img_tensor)
 
-        return result
+    return tuple(output[:batch_size] for output in outputs)
 
 
-def load_model(model_dir, full=False, device="cpu", **kwargs):
-    """Load model with better error handling and warnings"""
+def set_tag_context_size(model, tag_context_size=None):
+    """
+    Sets how many of the top initial predictions the refinement stage of the full model attends to, the model is
+    trained with model_info's tag_context_size (256). Smaller contexts make the refinement cheaper, None keeps it.
+    """
+    if tag_context_size is None:
+        return model
+
+    if not hasattr(model, "tag_context_size"):
+        print("! Only the full Camie model has a tag context, ignoring its size")
+        return model
+
+    total_tags = model.dataset.total_tags
+    assert 0 < tag_context_size <= total_tags, f"Tag context size must be between 1 and {total_tags}"
+
+    model.tag_context_size = tag_context_size
+    return model
+
+
+def set_cascade(model, band=None, threshold=DEFAULT_CASCADE_THRESHOLD, category_thresholds=None, tag_thresholds=None):
+    """
+    Opt-in cascade mode of the full model, see run_cascade. Images are only refined when the initial probability
+    of one of their tags is within `band` of its decision threshold, None refines every image. The decision thresholds
+    are those of get_threshold_vector, the score floor the predictions are filtered with is usually far lower.
+    """
+    if band and not hasattr(model, "forward_refined"):
+        print("! Only the full Camie model has a refinement stage, not using the cascade")
+        band = None
+
+    model.cascade_band = band
+    model.cascade_stats = {"images": 0, "refined": 0}
+
+    # Built once here, so the threshold vector cached for the predictions isn't replaced on every batch
+    model.cascade_thresholds = None
+    if band:
+        model.cascade_thresholds = torch.from_numpy(
+            model.dataset.threshold_vector(threshold, category_thresholds, tag_thresholds)
+        ).to(next(model.parameters()).device)
+
+    return model
+
+
+def run_cascade(model, img_tensor):
+    """
+    Runs the initial stage of the full model for the whole batch, and the refinement stage only for the images with
+    a tag whose initial probability is within `model.cascade_band` of its decision threshold. The other images are
+    confidently on one side of every threshold, their refined predictions are the initial ones. Counts are kept in
+    model.cascade_stats. The cascade runs eagerly, the batch size of the refinement stage changes from batch to batch.
+    """
+    with torch.no_grad(), autocast(model):
+        features, initial_preds = model.forward_initial(img_tensor)
+
+        initial_probs = torch.sigmoid(initial_preds.float())
+        uncertain = ((initial_probs - model.cascade_thresholds).abs() < model.cascade_band).any(dim=1)
+
+        refined_preds = initial_preds.clone()
+        if uncertain.any():
+            refined_preds[uncertain] = model.forward_refined(features[uncertain], initial_preds[uncertain]).to(
+                refined_preds.dtype
+            )
+
+    model.cascade_stats["images"] += uncertain.numel()
+    model.cascade_stats["refined"] += int(uncertain.sum())
+    return initial_preds, refined_preds
+
+
+def compile_model(model, batch_size, image_size=512):
+    """
+    Opt-in optimized path: a channels_last backbone and a torch.compile'd forward pass, run under inference_mode.
+    The forward pass is compiled for a single batch shape and warmed up here, so the first batch doesn't pay for it.
+    """
+    import time
+
+    device = next(model.parameters()).device
+    dtype = next(model.parameters()).dtype
+
+    model.backbone.to(memory_format=torch.channels_last)
+    model.compiled_forward = torch.compile(model.forward, dynamic=False)
+    model.compiled_batch_size = batch_size
+
+    print(f"* Compiling the Camie model for batches of {batch_size}...")
+    start_t = time.perf_counter()
+
+    try:
+        run_forward(model, torch.zeros(batch_size, 3, image_size, image_size, device=device, dtype=dtype))
+    except Exception as e:
+        # e.g. no C++ compiler for the CPU backend
+        print(f"! Could not compile the Camie model, running it eagerly: {str(e)}")
+        del model.compiled_forward
+        return model
+
+    print(f"* Compiled the Camie model in {time.perf_counter() - start_t:.1f}s")
+    return model
+
+
+class _ProbabilitiesModel(nn.Module):
+    """Wraps a tagger so the exported graph returns the initial and refined probabilities"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        initial_preds, refined_preds = self.model(x)
+        return torch.sigmoid(initial_preds), torch.sigmoid(refined_preds)
+
+
+def export_onnx(model, path, image_size=512, opset_version=17):
+    """
+    Exports a tagger to ONNX, with a dynamic batch dimension. The graph takes the preprocessed images and
+    returns the initial and refined probabilities, so it can run without torch.
+    """
+    import time
+
+    print(f"* Exporting the Camie model to ONNX: {path}")
+    start_t = time.perf_counter()
+
+    device = next(model.parameters()).device
+    wrapper = _ProbabilitiesModel(model).float().eval()
+
+    # Traced with a single image and without autograd, the activations of larger batches need gigabytes at 512px
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            (torch.zeros(1, 3, image_size, image_size, device=device),),
+            path,
+            dynamo=False,
+            input_names=["images"],
+            output_names=["initial_probabilities", "refined_probabilities"],
+            dynamic_axes={
+                "images": {0: "batch"},
+                "initial_probabilities": {0: "batch"},
+                "refined_probabilities": {0: "batch"},
+            },
+            opset_version=opset_version,
+        )
+
+    print(f"* Exported the Camie model in {time.perf_counter() - start_t:.1f}s")
+
+
+def get_threshold_vector(model, threshold=0, category_thresholds=None, tag_thresholds=None, device="cpu", dtype=None):
+    """
+    Returns the threshold of every tag from TagDataset.threshold_vector as a tensor on the model device.
+    """
+    # Only the last vector is kept, the thresholds usually stay the same for every batch
+    key = (threshold, category_thresholds, tag_thresholds, str(device), dtype)
+    cached = model.__dict__.get("_threshold_vector")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    threshold_vector = torch.from_numpy(
+        model.dataset.threshold_vector(threshold, category_thresholds, tag_thresholds)
+    ).to(device=device, dtype=dtype)
+
+    model._threshold_vector = (key, threshold_vector)
+    return threshold_vector
+
+
+def get_tags_from_predictions_batch(dataset, predictions, probabilities=None):
+    """
+    Shared by both taggers: finds the positive predictions of the whole batch at once and
+    moves only those to the CPU, then groups them by image and category.
+    """
+    if predictions.dim() == 1:
+        predictions = predictions.unsqueeze(0)
+    if probabilities is not None and probabilities.dim() == 1:
+        probabilities = probabilities.unsqueeze(0)
+
+    # Get (image, tag) indices of positive predictions
+    image_indices, tag_indices = torch.nonzero(predictions > 0, as_tuple=True)
+
+    probs = None
+    if probabilities is not None:
+        probs = probabilities[image_indices, tag_indices].float().cpu().numpy()
+
+    return dataset.group_tags(predictions.size(0), image_indices.cpu().numpy(), tag_indices.cpu().numpy(), probs)
+
+
+def load_state_dict(state_dict_path: str, device="cpu", mmap=True):
+    """
+    Loads a checkpoint's state dict. With `mmap`, the tensors are memory-mapped from the file instead of being read
+    into memory, which needs the zipfile format of torch.save, older checkpoints are read the regular way.
+    """
+    if mmap:
+        try:
+            return torch.load(state_dict_path, map_location=device, mmap=True, weights_only=True)
+        except RuntimeError as e:
+            print(f"! Could not memory-map {state_dict_path}, loading it into memory: {str(e)}")
+
+    return torch.load(state_dict_path, map_location=device, weights_only=True)
+
+
+def load_model(model_dir, full=False, device="cpu", precision=None, fast_load=True, **kwargs):
+    """
+    Load model with better error handling and warnings.
+    With `fast_load`, the model is built on the meta device and takes over the memory-mapped checkpoint tensors,
+    instead of initializing random weights and copying the checkpoint into them.
+    """
     # print(f"Loading model from {model_dir}")
 
     metadata_path = kwargs.pop("metadata_path", None)
     model_info_path = kwargs.pop("model_info_path", None)
     state_dict_path = kwargs.pop("state_dict_path", None)
+    thresholds_path = kwargs.pop("thresholds_path", None)
 
     # Load metadata
     metadata_path = metadata_path or os.path.join(model_dir, "metadata.json")
     if not os.path.exists(metadata_path):
         raise FileNotFoundError(f"Metadata file not found at {metadata_path}")
 
-    with open(metadata_path, "r") as f:
-        metadata = json.load(f)
-
     # Load model info
     model_info_path = model_info_path or os.path.join(model_dir, "model_info.json")
     if os.path.exists(model_info_path):
@@ -882,24 +1149,8 @@ def load_model(model_dir, full=False, device="cpu", **kwargs):
         print("WARNING: Model info file not found, using default settings")
         model_info = {"tag_context_size": 256, "num_heads": 16, "precision": "float16"}
 
-    # Create dataset wrapper
-    dataset = TagDataset(
-        total_tags=metadata["total_tags"],
-        idx_to_tag=metadata["idx_to_tag"],
-        tag_to_category=metadata["tag_to_category"],
-    )
-
-    # Initialize model with exact settings from model_info
-    if full:
-        model = ImageTagger(
-            total_tags=metadata["total_tags"],
-            dataset=dataset,
-            num_heads=model_info.get("num_heads", 16),
-            tag_context_size=model_info.get("tag_context_size", 256),
-            pretrained=False,
-        )
-    else:
-        model = InitialOnlyImageTagger(total_tags=metadata["total_tags"], dataset=dataset, pretrained=False)
+    # Create dataset wrapper, from a binary cache of metadata.json
+    dataset = load_tag_dataset(metadata_path)
 
     # Load weights
     state_dict_path = state_dict_path or os.path.join(
@@ -908,37 +1159,63 @@ def load_model(model_dir, full=False, device="cpu", **kwargs):
     if not os.path.exists(state_dict_path):
         raise FileNotFoundError(f"Model state dict not found at {state_dict_path}")
 
-    state_dict = torch.load(state_dict_path, map_location=device)
+    def build_model():
+        # Initialize model with exact settings from model_info
+        if full:
+            return ImageTagger(
+                total_tags=dataset.total_tags,
+                dataset=dataset,
+                num_heads=model_info.get("num_heads", 16),
+                tag_context_size=model_info.get("tag_context_size", 256),
+                pretrained=False,
+            )
 
-    # First try strict loading
-    try:
-        model.load_state_dict(state_dict, strict=True)
-        # print("✓ Model state dict loaded with strict=True successfully")
-    except Exception as e:
-        print(f"! Strict loading failed: {str(e)}")
-        print("Attempting non-strict loading...")
+        return InitialOnlyImageTagger(total_tags=dataset.total_tags, dataset=dataset, pretrained=False)
+
+    state_dict = load_state_dict(state_dict_path, device, mmap=fast_load)
+
+    model = None
+    if fast_load:
+        try:
+            # Built without allocating or initializing any weights, the checkpoint's tensors are then used as they are
+            with torch.device("meta"):
+                model = build_model()
+            model.load_state_dict(state_dict, strict=True, assign=True)
+
+            if any(tensor.is_meta for tensor in [*model.parameters(), *model.buffers()]):
+                raise RuntimeError("the checkpoint leaves tensors on the meta device")
+        except Exception as e:
+            print(f"! Fast loading failed, falling back to regular loading: {str(e)}")
+            model = None
+
+    if model is None:
+        model = build_model()
+
+        # First try strict loading
+        try:
+            model.load_state_dict(state_dict, strict=True)
+            # print("✓ Model state dict loaded with strict=True successfully")
+        except Exception as e:
+            print(f"! Strict loading failed: {str(e)}")
+            print("Attempting non-strict loading...")
 
-        # Try non-strict loading
-        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+            # Try non-strict loading
+            missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
 
-        print(f"Non-strict loading completed with:")
-        print(f"- {len(missing_keys)} missing keys")
-        print(f"- {len(unexpected_keys)} unexpected keys")
+            print(f"Non-strict loading completed with:")
+            print(f"- {len(missing_keys)} missing keys")
+            print(f"- {len(unexpected_keys)} unexpected keys")
 
-        if len(missing_keys) > 0:
-            print(f"Sample missing keys: {missing_keys[:5]}")
-        if len(unexpected_keys) > 0:
-            print(f"Sample unexpected keys: {unexpected_keys[:5]}")
+            if len(missing_keys) > 0:
+                print(f"Sample missing keys: {missing_keys[:5]}")
+            if len(unexpected_keys) > 0:
+                print(f"Sample unexpected keys: {unexpected_keys[:5]}")
 
     # Move model to device
     model = model.to(device)
 
-    # Set to half precision if needed
-    # if model_info.get('precision') == 'float16':
-    #     model = model.half()
-    #     print("✓ Model converted to half precision")
-    model = model.float()
-    # print("✓ Model converted to full precision")
+    # Full precision unless another precision is selected, model_info's precision is what the model was trained in
+    model = set_precision(model, precision or "fp32")
 
     # Set to eval mode
     model.eval()
@@ -946,10 +1223,10 @@ def load_model(model_dir, full=False, device="cpu", **kwargs):
 
     # Verify parameter dtype
     param_dtype = next(model.parameters()).dtype
-    # print(f"✓ Model loaded with precision: {param_dtype}")
+    print(f"* Camie model precision: {model.precision} ({param_dtype} weights)")
 
     thresholds = None
-    thresholds_path = os.path.join(model_dir, "thresholds.json")
+    thresholds_path = thresholds_path or os.path.join(model_dir, "thresholds.json")
     if os.path.exists(thresholds_path):
         with open(thresholds_path, "r") as f:
             thresholds = json.load(f)
@@ -985,12 +1262,12 @@ if __name__ == "__main__":
             # Use category thresholds if available
             if thresholds and "categories" in thresholds:
                 print("Using category thresholds.")
-                category_thresholds = {
-                    cat: opt["balanced"]["threshold"] for cat, opt in thresholds["categories"].items()
-                }
-                results = model.predict(image_path, category_thresholds=category_thresholds)
+                category_thresholds, tag_thresholds = thresholds_for_profile(thresholds, "balanced")
+                results = model.predict(
+                    Image.open(image_path), category_thresholds=category_thresholds, tag_thresholds=tag_thresholds
+                )
             else:
-                results = model.predict(image_path)
+                results = model.predict(Image.open(image_path))
 
             # Get tags
             tags = model.get_tags_from_predictions(
@@ -0,0 +1,158 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from PIL import Image
+
+from yadt import onnx_session
+from yadt.tagger_camie_dataset import TagDataset
+from yadt.tagger_camie_preprocess import IMAGE_SIZE, letterbox_into
+
+
+def _export_model(
+    state_dict_path: str,
+    onnx_path: str,
+    full: bool,
+    metadata_path: str,
+    model_info_path: str,
+    tag_context_size: Optional[int] = None,
+):
+    from yadt.tagger_camie_model import export_onnx, load_model, set_tag_context_size
+
+    model, _, _ = load_model(
+        ".",
+        full=full,
+        metadata_path=metadata_path,
+        model_info_path=model_info_path,
+        state_dict_path=state_dict_path,
+        device="cpu",
+    )
+    set_tag_context_size(model, tag_context_size)
+    export_onnx(model, onnx_path, image_size=IMAGE_SIZE)
+
+
+def exported_model(
+    state_dict_path: str, full: bool, metadata_path: str, model_info_path: str, tag_context_size: Optional[int] = None
+) -> str:
+    """
+    Returns the path to the ONNX export of a Camie model, exporting it on first use.
+    The tag context size is part of the graph, so every size has its own export.
+    Only the export needs torch, running the exported model doesn't.
+    """
+    from yadt import model_cache
+
+    variant = "onnx-full" if full else "onnx-initial"
+    if full and tag_context_size is not None:
+        variant += f"-context{tag_context_size}"
+
+    return model_cache.cached_file(
+        state_dict_path,
+        variant,
+        ".onnx",
+        lambda source_path, path: _export_model(
+            source_path, path, full, metadata_path, model_info_path, tag_context_size
+        ),
+    )
+
+
+class OnnxImageTagger:
+    """
+    Runs an exported Camie model on onnxruntime, through the same batched session as the SmilingWolf taggers.
+    Offers the predict_batch and get_tags_from_predictions_batch methods of the torch models, on NumPy arrays.
+    """
+
+    def __init__(self, model_path: str, dataset: TagDataset, batch_size: int, **kwargs):
+        session = onnx_session.create_session(model_path, **onnx_session.pop_session_kwargs(kwargs))
+        output_shapes = [(dataset.total_tags, np.float32), (dataset.total_tags, np.float32)]
+
+        self.dataset = dataset
+        self.session = onnx_session.BatchedSession(session, batch_size, np.float32, output_shapes)
+        self.batch_size = self.session.batch_size
+        self.image_size = self.session.batch_buffer.shape[-1]
+        self._threshold_vector = None
+
+    def get_threshold_vector(self, threshold=0, category_thresholds=None, tag_thresholds=None) -> np.ndarray:
+        # Only the last vector is kept, the thresholds usually stay the same for every batch
+        key = (threshold, category_thresholds, tag_thresholds)
+        if self._threshold_vector is None or self._threshold_vector[0] != key:
+            self._threshold_vector = (
+                key,
+                self.dataset.threshold_vector(threshold, category_thresholds, tag_thresholds),
+            )
+
+        return self._threshold_vector[1]
+
+    def predict_batch(
+        self,
+        images: List[Image.Image],
+        threshold: float = 0,
+        category_thresholds: Optional[Dict[str, float]] = None,
+        tag_thresholds: Optional[Dict[str, float]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Run inference on a list of images, with support for category-specific and per-tag thresholds.
+        The returned arrays have one row per image.
+        """
+        session = self.session
+
+        probabilities = []
+        with session.lock:
+            for i in range(0, len(images), session.batch_size):
+                batch_images = images[i : i + session.batch_size]
+                batch = session.batch_buffer[: len(batch_images)]
+
+                for image, out in zip(batch_images, batch):
+                    letterbox_into(image, out)
+
+                # The output buffers are overwritten by the next batch, so the results get their own copy
+                probabilities.append([output.copy() for output in session.run(batch)])
+
+        return self._results(probabilities, threshold, category_thresholds, tag_thresholds)
+
+    def predict_preprocessed(
+        self,
+        batch: np.ndarray,
+        threshold: float = 0,
+        category_thresholds: Optional[Dict[str, float]] = None,
+        tag_thresholds: Optional[Dict[str, float]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Like predict_batch, for a (batch, 3, height, width) float32 batch that is already preprocessed,
+        e.g. by tagger_camie_preprocess.Preprocessor.
+        """
+        session = self.session
+
+        probabilities = []
+        with session.lock:
+            for i in range(0, len(batch), session.batch_size):
+                chunk = batch[i : i + session.batch_size]
+
+                # Copied into the bound input buffer like the images of predict_batch
+                buffer = session.batch_buffer[: len(chunk)]
+                np.copyto(buffer, chunk)
+
+                probabilities.append([output.copy() for output in session.run(buffer)])
+
+        return self._results(probabilities, threshold, category_thresholds, tag_thresholds)
+
+    def _results(self, probabilities, threshold, category_thresholds, tag_thresholds) -> Dict[str, np.ndarray]:
+        initial_probs, refined_probs = (np.concatenate(outputs) for outputs in zip(*probabilities))
+        threshold_vector = self.get_threshold_vector(threshold, category_thresholds, tag_thresholds)
+
+        return {
+            "initial_probabilities": initial_probs,
+            "refined_probabilities": refined_probs,
+            "predictions": refined_probs >= threshold_vector,
+        }
+
+    def get_tags_from_predictions_batch(self, predictions: np.ndarray, probabilities: np.ndarray = None):
+        """
+        Convert a batch of model predictions to human-readable tags grouped by category, one dict per image.
+        """
+        image_indices, tag_indices = np.nonzero(predictions)
+
+        probs = None
+        if probabilities is not None:
+            probs = probabilities[image_indices, tag_indices]
+
+        return self.dataset.group_tags(len(predictions), image_indices, tag_indices, probs)
@@ -0,0 +1,106 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterator, List, Sequence
+
+import numpy as np
+
+from PIL import Image
+
+IMAGE_SIZE = 512
+
+
+def letterbox_into(image: Image.Image, out: np.ndarray) -> np.ndarray:
+    """
+    Preprocesses an image into `out`, a (3, height, width) float32 array, e.g. a view of a batch buffer.
+    Bit-identical to preprocess_image of the torch models: resized to fit with LANCZOS, padded with black and scaled
+    to [0, 1], without the intermediate canvas image and tensor.
+    """
+    image_size = out.shape[-1]
+
+    # Convert RGBA or Palette images to RGB
+    if image.mode in ("RGBA", "P"):
+        image = image.convert("RGB")
+
+    # Calculate new dimensions to maintain aspect ratio
+    width, height = image.size
+    aspect_ratio = width / height
+
+    if aspect_ratio > 1:
+        new_width = image_size
+        new_height = int(new_width / aspect_ratio)
+    else:
+        new_height = image_size
+        new_width = int(new_height * aspect_ratio)
+
+    # Resize with LANCZOS filter, pasting onto the RGB canvas converts the other modes the same way
+    image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # Pad with black
+    paste_x = (image_size - new_width) // 2
+    paste_y = (image_size - new_height) // 2
+
+    out.fill(0)
+    region = out[:, paste_y : paste_y + new_height, paste_x : paste_x + new_width]
+    region[...] = np.asarray(image).transpose(2, 0, 1)
+    region /= 255
+
+    return out
+
+
+class Preprocessor:
+    """
+    Preprocesses images into preallocated batches on a thread pool. While the caller runs a batch through the model,
+    the images of the next batch are decoded and letterboxed into a second buffer, so preprocessing overlaps with
+    inference. PIL releases the GIL while decoding and resizing, so the workers also run in parallel.
+    """
+
+    def __init__(self, batch_size: int, image_size: int = IMAGE_SIZE, num_workers: int = None):
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.num_workers = num_workers or min(batch_size, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="camie-preprocess")
+        self.lock = threading.Lock()
+
+        # One buffer is filled while the other one is used by the model
+        self.buffers = [np.zeros((batch_size, 3, image_size, image_size), dtype=np.float32) for _ in range(2)]
+
+    def _submit(self, images: List[Image.Image], buffer: np.ndarray):
+        batch = buffer[: len(images)]
+        return batch, [self.executor.submit(letterbox_into, image, out) for image, out in zip(images, batch)]
+
+    def batches(self, images: Sequence[Image.Image], batch_size: int = None) -> Iterator[np.ndarray]:
+        """
+        Yields the images preprocessed in (batch, 3, image_size, image_size) float32 batches of up to `batch_size`.
+        The next batch is prepared while the caller uses the current one, which stays valid until the next iteration.
+        `images` is only sliced one batch ahead, so it can be a sequence that opens its images when sliced.
+        """
+        batch_size = min(batch_size or self.batch_size, self.batch_size)
+        starts = range(0, len(images), batch_size)
+
+        with self.lock:
+            pending = self._submit(images[:batch_size], self.buffers[0]) if starts else None
+
+            try:
+                for i in range(len(starts)):
+                    batch, futures = pending
+                    for future in futures:
+                        future.result()
+
+                    # The other buffer was used by the previous batch, which the caller is done with by now
+                    pending = None
+                    if i + 1 < len(starts):
+                        chunk = images[starts[i + 1] : starts[i + 1] + batch_size]
+                        pending = self._submit(chunk, self.buffers[(i + 1) % 2])
+
+                    yield batch
+            finally:
+                # When the caller stops early, the images in flight still write into the buffers
+                if pending:
+                    wait(pending[1])
+
+    def shutdown(self):
+        """Stops the worker threads, once the preprocessor is no longer used"""
+        self.executor.shutdown(wait=True)
@@ -1,3 +1,5 @@
+from typing import List
+
 import huggingface_hub
 
 from PIL import Image
@@ -7,6 +9,23 @@ MODEL_REPO_PREFIX = "MiaoshouAI/"
 FLORENCE2_PROMPTGEN_LARGE = "MiaoshouAI/Florence-2-large-PromptGen-v2.0"
 FLORENCE2_PROMPTGEN_BASE = "MiaoshouAI/Florence-2-base-PromptGen-v2.0"
 
+DEFAULT_BATCH_SIZE = 4
+
+# Generate arguments of the decoding profiles, fewer beams and tokens trade some tag quality for speed.
+# A PromptGen tag list is typically 30 to 60 tags of a few tokens each, which fits in the 256 token budget.
+# Looping tag lists are stopped early (see RepetitionStoppingCriteria): per image with greedy decoding, but with beam
+# search only once every beam of every image in the batch loops.
+DECODING_PROFILES = {
+    "beam search": {"num_beams": 3, "max_new_tokens": 1024},
+    "small beam": {"num_beams": 2, "max_new_tokens": 1024},
+    "greedy": {"num_beams": 1, "max_new_tokens": 1024},
+    "greedy, 256 tokens": {"num_beams": 1, "max_new_tokens": 256},
+}
+DEFAULT_DECODING_PROFILE = "beam search"
+
+# Generation stops after this many tags without a new unique one, see RepetitionStoppingCriteria
+DEFAULT_REPETITION_WINDOW = 8
+
 
 class Predictor:
     def __init__(self):
@@ -14,9 +33,28 @@ class Predictor:
         self.processor = None
         self.prompt = "<GENERATE_TAGS>"
         self.device = None
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.decoding_profile = DEFAULT_DECODING_PROFILE
+        self.repetition_window = DEFAULT_REPETITION_WINDOW
+        self.separator_token_ids = []
+        self.tokens_saved = []
 
     def load_model(self, model_repo: str, **kwargs):
         self.device = kwargs.pop("device", None)
+
+        batch_size = int(kwargs.pop("batch_size", DEFAULT_BATCH_SIZE))
+        assert batch_size > 0, "Batch size must be at least 1"
+        self.batch_size = batch_size
+
+        decoding_profile = kwargs.pop("decoding_profile", None) or DEFAULT_DECODING_PROFILE
+        assert decoding_profile in DECODING_PROFILES, f"Unknown decoding profile: {decoding_profile}"
+        self.decoding_profile = decoding_profile
+
+        # 0 turns the early stopping off
+        repetition_window = int(kwargs.pop("repetition_window", DEFAULT_REPETITION_WINDOW))
+        assert repetition_window >= 0, "Repetition window can't be negative"
+        self.repetition_window = repetition_window
+
         import os
 
         from yadt.tagger_florence2_promptgen_model import load_model
@@ -41,30 +79,103 @@ class Predictor:
             if self.device is not None:
                 self.model.to(self.device)
 
-    def predict(self, image: Image):
+        from yadt.tagger_florence2_promptgen_model import separator_token_ids
+
+        # Scanning the vocabulary takes a while, so it's done once per model instead of on every batch
+        self.separator_token_ids = separator_token_ids(self.processor.tokenizer)
+
+    def predict_batch(
+        self,
+        images: List[Image.Image],
+        batch_size: int = None,
+        score_floor: float = 0.0,
+        decoding_profile: str = None,
+    ):
+        """
+        Predicts a list of images, generating the tags of up to `batch_size` images per generate call.
+        `decoding_profile` is one of DECODING_PROFILES, the one given to load_model by default.
+        Returns ({}, tags, {}) for each image, Florence doesn't score its tags so every tag scores 1.0.
+        """
         assert self.model is not None, "No model loaded"
         assert self.processor is not None, "No model processor loaded"
 
+        decoding_profile = decoding_profile or self.decoding_profile
+        assert decoding_profile in DECODING_PROFILES, f"Unknown decoding profile: {decoding_profile}"
+
+        batch_size = batch_size or self.batch_size
+        generate_kwargs = DECODING_PROFILES[decoding_profile]
+        tokenizer = self.processor.tokenizer
+
+        stopping_criteria = None
+        if self.repetition_window:
+            from transformers import StoppingCriteriaList
+
+            from yadt.tagger_florence2_promptgen_model import RepetitionStoppingCriteria
+
+            stopping_criteria = StoppingCriteriaList(
+                [RepetitionStoppingCriteria(self.separator_token_ids, self.repetition_window)]
+            )
+
+        predictions = []
+        self.tokens_saved = []
+        for i in range(0, len(images), batch_size):
+            batch_images = [self._rgb_image(image) for image in images[i : i + batch_size]]
+
+            # The prompt is the same for every image, so the padding never kicks in and no attention mask is needed
+            inputs = self.processor(
+                text=[self.prompt] * len(batch_images), images=batch_images, return_tensors="pt", padding=True
+            )
+            if self.device is not None:
+                inputs = inputs.to(self.device)
+
+            # The vision encoder and the beam search run on the whole batch at once
+            generated_ids = self.model.generate(
+                input_ids=inputs["input_ids"],
+                pixel_values=inputs["pixel_values"],
+                do_sample=False,
+                stopping_criteria=stopping_criteria,
+                **generate_kwargs,
+            )
+            generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=False)
+
+            for image, token_ids, generated_text in zip(batch_images, generated_ids.tolist(), generated_texts):
+                parsed_answer = self.processor.post_process_generation(
+                    generated_text, task=self.prompt, image_size=(image.width, image.height)
+                )
+                tags = [tag.strip() for tag in parsed_answer[self.prompt].split(",")]
+
+                # Sequences that ended before the others in the batch are padded, the first token starts the decoder
+                while token_ids and token_ids[-1] == tokenizer.pad_token_id:
+                    token_ids.pop()
+                generated_tokens = len(token_ids) - 1
+
+                # Without an end of sequence token, generation was stopped early or ran out of tokens and the last
+                # tag may be cut off. Stopping early would have looped until running out of tokens otherwise.
+                tokens_saved = 0
+                if token_ids[-1] != tokenizer.eos_token_id:
+                    tags = tags[:-1] if len(tags) > 1 else tags
+                    tokens_saved = max(0, generate_kwargs["max_new_tokens"] - generated_tokens)
+
+                self.tokens_saved.append(tokens_saved)
+
+                predictions.append(({}, {tag: 1.0 for tag in tags}, {}))
+
+        if any(self.tokens_saved):
+            print(
+                f"* Stopped {sum(saved > 0 for saved in self.tokens_saved)} repeating Florence-2 generations early, "
+                f"saving {sum(self.tokens_saved)} tokens"
+            )
+
+        return predictions
+
+    def predict(self, image: Image, decoding_profile: str = None):
+        return self.predict_batch([image], decoding_profile=decoding_profile)[0]
+
+    @staticmethod
+    def _rgb_image(image: Image.Image) -> Image.Image:
         if getattr(image, "mode", "NOT_RGB") != "RGB":
             rgb_image = Image.new("RGB", image.size, (255, 255, 255))
             rgb_image.paste(image)
             image = rgb_image
 
-        inputs = self.processor(text=self.prompt, images=image, return_tensors="pt")
-        if self.device is not None:
-            inputs = inputs.to(self.device)
-
-        generated_ids = self.model.generate(
-            input_ids=inputs["input_ids"],
-            pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024,
-            do_sample=False,
-            num_beams=3,
-        )
-        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-
-        parsed_answer: str = self.processor.post_process_generation(
-            generated_text, task=self.prompt, image_size=(image.width, image.height)
-        )
-
-        return {}, {tag.strip(): 1.0 for tag in parsed_answer[self.prompt].split(",")}, {}
+        return image
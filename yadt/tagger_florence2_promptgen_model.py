@@ -1,3 +1,6 @@
+from typing import Iterable, List
+
+
 def load_model(device="cpu", **kwargs):
     from transformers import AutoModelForCausalLM, AutoProcessor
     import os
@@ -20,6 +23,59 @@ def load_model(device="cpu", **kwargs):
     return model, processor
 
 
+def separator_token_ids(tokenizer, separator: str = ",") -> List[int]:
+    """
+    Returns the ids of every token of the vocabulary that contains `separator`. BPE merges the comma with its
+    neighbours into tokens like ",\"" or "),", so the "," token alone misses some of the tag boundaries.
+    """
+    return sorted(token_id for token, token_id in tokenizer.get_vocab().items() if separator in token)
+
+
+class RepetitionStoppingCriteria:
+    """
+    Stopping criterion for model.generate (the transformers StoppingCriteria interface) that stops the sequences which
+    generated no new unique tag within the last `window` tags, i.e. tag lists that started to loop. Tags are the token
+    runs between separator tokens (see separator_token_ids), so nothing is decoded while generating.
+    The text a merged separator token shares with a tag isn't part of that tag's run. A loop repeats the same tokens,
+    so it's still found, but the same tag may not match when it's merged with the comma only once.
+    Greedy decoding stops every such sequence on its own. With beam search, generate only stops once every beam of
+    every image in the batch loops, so a single image that keeps finding new tags keeps the whole batch running.
+    """
+
+    def __init__(self, separator_token_ids: Iterable[int], window: int = 8):
+        self.separator_token_ids = set(separator_token_ids)
+        self.window = window
+        self._separators = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        if self._separators is None or self._separators.device != input_ids.device:
+            self._separators = torch.tensor(sorted(self.separator_token_ids), device=input_ids.device)
+
+        is_done = torch.zeros(len(input_ids), dtype=torch.bool, device=input_ids.device)
+
+        # A tag is only complete at a separator, so the other sequences can't have started to repeat
+        for row in torch.nonzero(torch.isin(input_ids[:, -1], self._separators)).flatten().tolist():
+            is_done[row] = self.is_repeating(input_ids[row].tolist())
+
+        return is_done
+
+    def is_repeating(self, token_ids) -> bool:
+        # The whole sequence is checked, beam search reorders the sequences between steps
+        seen = set()
+        last_new, count, start = -1, 0, 0
+        for i, token_id in enumerate(token_ids):
+            if token_id in self.separator_token_ids:
+                tag = tuple(token_ids[start:i])
+                if tag not in seen:
+                    seen.add(tag)
+                    last_new = count
+                count, start = count + 1, i + 1
+
+        return count - 1 - last_new >= self.window
+
+
 # Example usage
 if __name__ == "__main__":
     import sys
@@ -1,4 +1,4 @@
-from typing import Tuple, Dict
+from typing import Any, Tuple, Dict, List
 
 from PIL import Image
 
@@ -10,14 +10,22 @@ from yadt import tagger_florence2_promptgen
 class Predictor:
     def __init__(self):
         self.last_loaded_repo = None
+        self.last_loaded_kwargs = None
         self.model: "Predictor" = None
 
     def load_model(self, model_repo: str, is_custom_model: bool, **kwargs):
-        if self.last_loaded_repo == model_repo:
+        kwargs = model_options(model_repo, kwargs)
+
+        if self.last_loaded_repo == model_repo and self.last_loaded_kwargs == kwargs:
             return
         errors = []
         print(f"Loading model: {model_repo}")
 
+        # Release the worker threads of the model being replaced, it can't be used after that
+        if hasattr(self.model, "close"):
+            self.model.close()
+            self.model, self.last_loaded_repo, self.last_loaded_kwargs = None, None, None
+
         if model_repo.startswith(tagger_smilingwolf.MODEL_REPO_PREFIX):
             from yadt.tagger_smilingwolf import Predictor
 
@@ -48,17 +56,121 @@ class Predictor:
             raise AssertionError("Model is not supported: " + model_repo)
 
         self.last_loaded_repo = model_repo
+        self.last_loaded_kwargs = kwargs
+
+    def _predict_kwargs(self, decoding_profile: str = None) -> Dict[str, Any]:
+        # Only the generative models have decoding profiles
+        if decoding_profile is not None and hasattr(self.model, "decoding_profile"):
+            return {"decoding_profile": decoding_profile}
+        return {}
+
+    def predict(
+        self, image: Image, decoding_profile: str = None
+    ) -> Tuple[str, Dict[str, float], Dict[str, float], Dict[str, float]]:
+        assert self.model is not None, "No model loaded"
+        return self.model.predict(image, **self._predict_kwargs(decoding_profile))
 
-    def predict(self, image: Image) -> Tuple[str, Dict[str, float], Dict[str, float], Dict[str, float]]:
+    def predict_batch(
+        self, images: List[Image.Image], score_floor: float = 0.0, decoding_profile: str = None
+    ) -> List[Tuple[Dict[str, float], Dict[str, float], Dict[str, float]]]:
         assert self.model is not None, "No model loaded"
-        return self.model.predict(image)
+        predict_kwargs = self._predict_kwargs(decoding_profile)
+
+        # Not every model supports batching, so fall back to predicting each image on its own
+        if hasattr(self.model, "predict_batch"):
+            return self.model.predict_batch(images, score_floor=score_floor, **predict_kwargs)
+
+        return [self.model.predict(image, **predict_kwargs) for image in images]
+
+
+def model_options(model_repo: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the load_model options of a model, the per-model settings take precedence over the command line ones"""
+    kwargs = dict(kwargs)
+    model_config = kwargs.pop("model_config", None) or {}
+    kwargs.update(model_config.get(model_repo, {}))
+    return kwargs
+
+
+def dataset_cache_key(
+    model_repo: str, decoding_profile: str = None, kwargs: Dict[str, Any] = None, score_floor: float = None
+) -> str:
+    """
+    Returns the key the predictions of a model are cached under in the dataset cache, given the load_model `kwargs`.
+    Options that change the predictions get their own key, so their results never mix with the default ones:
+    the decoding profiles of the Florence-2 models, the top-k restriction of the SmilingWolf models and the tag context
+    size, cascade and threshold profile of the Camie models. The scored models also cache apart per `score_floor`.
+    """
+    options = model_options(model_repo, kwargs or {})
+    variant = []
+
+    if (
+        model_repo.startswith(tagger_florence2_promptgen.MODEL_REPO_PREFIX)
+        and decoding_profile
+        and decoding_profile != tagger_florence2_promptgen.DEFAULT_DECODING_PROFILE
+    ):
+        variant.append(decoding_profile)
+
+    if model_repo.startswith(tagger_smilingwolf.MODEL_REPO_PREFIX) and options.get("top_k"):
+        variant.append(f"top {int(options['top_k'])}")
+
+    if model_repo.startswith(tagger_camie.MODEL_REPO_PREFIX) and options.get("tag_context_size"):
+        variant.append(f"context {int(options['tag_context_size'])}")
+
+    if model_repo.startswith(tagger_camie.MODEL_REPO_PREFIX) and options.get("cascade_band"):
+        variant.append(f"cascade {float(options['cascade_band'])}")
+
+    # The thresholds of a profile replace the score floor, so they change which tags are stored
+    if model_repo.startswith(tagger_camie.MODEL_REPO_PREFIX) and options.get("threshold_profile"):
+        variant.append(f"profile {options['threshold_profile']}")
+
+    # Florence-2 doesn't score its tags, so there is nothing below the floor
+    if score_floor is not None and not model_repo.startswith(tagger_florence2_promptgen.MODEL_REPO_PREFIX):
+        variant.append(f"floor {float(score_floor)}")
+
+    return f"{model_repo} ({', '.join(variant)})" if variant else model_repo
+
+
+def load_model_config(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Loads the per-model config, a JSON object mapping model repos (or custom model paths) to load_model options:
+        {"SmilingWolf/wd-eva02-large-tagger-v3": {"intra_op_num_threads": 16, "batch_size": 4}}
+    """
+    import json
+
+    if not path:
+        return {}
+
+    with open(path, "r") as f:
+        model_config = json.load(f)
+
+    assert isinstance(model_config, dict), f"Model config is not a JSON object: {path}"
+    return model_config
+
+
+def model_kwargs(args) -> Dict[str, Any]:
+    """Collects the load_model options given on the command line"""
+    from yadt import onnx_session
+
+    return {
+        "device": args.device,
+        "batch_size": args.batch_size,
+        "uint8_input": args.uint8_input,
+        "top_k": args.top_k,
+        "precision": args.precision,
+        "torch_compile": args.torch_compile,
+        "backend": args.camie_backend,
+        "tag_context_size": args.camie_tag_context_size,
+        "cascade_band": args.camie_cascade_band,
+        **onnx_session.session_kwargs(args),
+        "model_config": load_model_config(args.model_config),
+    }
 
 
 predictor = Predictor()
 
 default_repo = tagger_smilingwolf.EVA02_LARGE_MODEL_DSV3_REPO
 
-dropdown_list = [
+smilingwolf_list = [
     tagger_smilingwolf.SWINV2_MODEL_DSV3_REPO,
     tagger_smilingwolf.CONV_MODEL_DSV3_REPO,
     tagger_smilingwolf.VIT_MODEL_DSV3_REPO,
@@ -69,8 +181,16 @@ dropdown_list = [
     tagger_smilingwolf.CONV_MODEL_DSV2_REPO,
     tagger_smilingwolf.CONV2_MODEL_DSV2_REPO,
     tagger_smilingwolf.VIT_MODEL_DSV2_REPO,
+]
+
+dropdown_list = [
+    # Each SmilingWolf model is followed by its INT8 quantized variant
+    *[variant for repo in smilingwolf_list for variant in (repo, repo + tagger_smilingwolf.INT8_VARIANT_SUFFIX)],
     tagger_florence2_promptgen.FLORENCE2_PROMPTGEN_LARGE,
     tagger_florence2_promptgen.FLORENCE2_PROMPTGEN_BASE,
+    # The Camie models are followed by their INT8 variants, which run on onnxruntime
     tagger_camie.CAMIE_MODEL_FULL,
+    tagger_camie.CAMIE_MODEL_FULL + tagger_camie.INT8_VARIANT_SUFFIX,
     tagger_camie.CAMIE_MODEL_INITIAL_ONLY,
+    tagger_camie.CAMIE_MODEL_INITIAL_ONLY + tagger_camie.INT8_VARIANT_SUFFIX,
 ]
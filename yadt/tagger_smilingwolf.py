@@ -1,11 +1,12 @@
-from typing import List
+from typing import List, Tuple
 import huggingface_hub
 import numpy as np
-import onnxruntime as rt
-import pandas as pd
 
 from PIL import Image
 
+from yadt import onnx_session
+from yadt.process_prediction import PredictionResult
+
 MODEL_REPO_PREFIX = "SmilingWolf/"
 
 # SmilingWolf v3 series:
@@ -22,32 +23,70 @@ CONV_MODEL_DSV2_REPO = "SmilingWolf/wd-v1-4-convnext-tagger-v2"
 CONV2_MODEL_DSV2_REPO = "SmilingWolf/wd-v1-4-convnextv2-tagger-v2"
 VIT_MODEL_DSV2_REPO = "SmilingWolf/wd-v1-4-vit-tagger-v2"
 
+# Suffix for the locally quantized variant of a model, e.g. "SmilingWolf/wd-vit-tagger-v3 (int8)"
+INT8_VARIANT_SUFFIX = " (int8)"
+
 # Files to download from the repos
 MODEL_FILENAME = "model.onnx"
 LABEL_FILENAME = "selected_tags.csv"
 
+# Maximum number of images stacked into a single inference run
+DEFAULT_BATCH_SIZE = 8
+
+
+def _build_label_cache(csv_path: str, cache_path: str):
+    import csv
+
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    categories = np.array([int(row["category"]) for row in rows], dtype=np.int16)
+
+    with open(cache_path, "wb") as f:
+        np.savez(
+            f,
+            tag_names=np.array([row["name"] for row in rows], dtype=str),
+            categories=categories,
+            rating_indexes=np.flatnonzero(categories == 9),
+            general_indexes=np.flatnonzero(categories == 0),
+            character_indexes=np.flatnonzero(categories == 4),
+        )
+
+
+def load_labels(csv_path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loads the tag names and the rating, general and character index arrays of a selected_tags.csv.
+    The csv is parsed once per model into a binary cache, later loads read that instead.
+    """
+    from yadt import model_cache
 
-def load_labels(dataframe) -> List[str]:
-    name_series = dataframe["name"]
-    tag_names = name_series.tolist()
+    cache_path = model_cache.cached_file(csv_path, "labels", ".npz", _build_label_cache)
+
+    with np.load(cache_path, allow_pickle=False) as labels:
+        # Object array, so building the result dicts reuses the tag name strings instead of copying them
+        tag_names = labels["tag_names"].astype(object)
+        rating_indexes = labels["rating_indexes"].astype(np.intp)
+        general_indexes = labels["general_indexes"].astype(np.intp)
+        character_indexes = labels["character_indexes"].astype(np.intp)
 
-    rating_indexes = list(np.where(dataframe["category"] == 9)[0])
-    general_indexes = list(np.where(dataframe["category"] == 0)[0])
-    character_indexes = list(np.where(dataframe["category"] == 4)[0])
     return tag_names, rating_indexes, general_indexes, character_indexes
 
 
 class Predictor:
     model_target_size: int
     model: str
-    tag_names: List[str]
-    rating_indexes: List[str]
-    general_indexes: List[str]
-    character_indexes: List[str]
+    batch_size: int
+    tag_names: np.ndarray
+    rating_indexes: np.ndarray
+    general_indexes: np.ndarray
+    character_indexes: np.ndarray
 
     def __init__(self):
         self.model_target_size = None
         self.model = None
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.session = None
+        self.top_k = None
 
     def download_model(self, model_repo):
         import os
@@ -78,23 +117,64 @@ class Predictor:
             return csv_path, model_path
 
     def load_model(self, model_repo, **kwargs):
+        quantized = model_repo.endswith(INT8_VARIANT_SUFFIX)
+        model_repo = model_repo.removesuffix(INT8_VARIANT_SUFFIX)
+
         csv_path, model_path = self.download_model(model_repo)
 
-        tags_df = pd.read_csv(csv_path)
-        sep_tags = load_labels(tags_df)
+        if quantized:
+            model_path = onnx_session.quantized_model(model_path)
+
+        # Feed the model uint8 pixels, which it casts to float32 itself
+        uint8_input = bool(kwargs.pop("uint8_input", False))
+        if uint8_input:
+            model_path = onnx_session.uint8_input_model(model_path)
+
+        self.tag_names, self.rating_indexes, self.general_indexes, self.character_indexes = load_labels(csv_path)
 
-        self.tag_names = sep_tags[0]
-        self.rating_indexes = sep_tags[1]
-        self.general_indexes = sep_tags[2]
-        self.character_indexes = sep_tags[3]
+        # Only let the rating scores and the k best scoring tags out of the model
+        top_k = kwargs.pop("top_k", None)
+        if top_k:
+            top_k = min(int(top_k), len(self.tag_names))
+            model_path = onnx_session.top_k_model(model_path, top_k, self.rating_indexes.tolist())
 
-        model = rt.InferenceSession(model_path)
+        self.is_general = np.zeros(len(self.tag_names), dtype=bool)
+        self.is_general[self.general_indexes] = True
+        self.is_character = np.zeros(len(self.tag_names), dtype=bool)
+        self.is_character[self.character_indexes] = True
+
+        batch_size = int(kwargs.pop("batch_size", DEFAULT_BATCH_SIZE))
+        assert batch_size > 0, "Batch size must be at least 1"
+
+        model = onnx_session.create_session(model_path, **onnx_session.pop_session_kwargs(kwargs))
+        model_outputs = model.get_outputs()
         _, height, width, _ = model.get_inputs()[0].shape
 
+        if top_k:
+            output_shapes = [(len(self.rating_indexes), np.float32), (top_k, np.float32), (top_k, np.int64)]
+        else:
+            num_tags = len(self.tag_names)
+            if isinstance(model_outputs[0].shape[-1], int):
+                assert (
+                    model_outputs[0].shape[-1] == num_tags
+                ), f"Model has {model_outputs[0].shape[-1]} outputs but {num_tags} tags"
+
+            output_shapes = [(num_tags, np.float32)]
+
+        # Images are preprocessed straight into the session's batch buffer
+        session = onnx_session.BatchedSession(model, batch_size, np.uint8 if uint8_input else np.float32, output_shapes)
+
         self.model_target_size = height
         self.model = model
+        self.session = session
+        self.batch_size = session.batch_size
+        self.top_k = top_k
 
     def prepare_image(self, image):
+        """
+        Reference preprocessing, which composites and pads the image at its full resolution before resizing.
+        Inference uses `prepare_image_into`, this is kept to compare against it.
+        """
         target_size = self.model_target_size
 
         # image_shape = image.size
@@ -130,27 +210,127 @@ class Predictor:
 
         return np.expand_dims(image_array, axis=0)
 
-    def predict(self, image: Image):
-        assert self.model is not None, "No model loaded"
+    def prepare_image_into(self, image: Image.Image, out: np.ndarray):
+        """
+        Preprocesses an image into `out`, a (height, width, 3) float32 or uint8 BGR view of the batch buffer.
+
+        The image is resized before it is padded and composited onto white, so apart from
+        decoding, nothing is allocated at the full resolution of the image.
+        """
+        target_size = self.model_target_size
+
+        has_alpha = (
+            image.mode in ("RGBA", "LA", "PA")
+            or "transparency" in image.info
+            or (image.mode == "P" and image.palette.mode == "RGBA")
+        )
+        mode = "RGBA" if has_alpha else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
+
+        # Resize so the longest side matches the target size
+        width, height = image.size
+        max_dim = max(width, height)
+        new_width = max(1, round(width * target_size / max_dim))
+        new_height = max(1, round(height * target_size / max_dim))
+
+        if (new_width, new_height) != image.size:
+            # Pillow premultiplies the alpha channel while resizing, so transparent pixels don't bleed in
+            image = image.resize((new_width, new_height), Image.BICUBIC)
 
-        image = self.prepare_image(image)
+        pixels = np.asarray(image)
 
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        preds = self.model.run([label_name], {input_name: image})[0]
+        # Pad image to square
+        pad_left = (target_size - new_width) // 2
+        pad_top = (target_size - new_height) // 2
+
+        out.fill(255)
+        region = out[pad_top : pad_top + new_height, pad_left : pad_left + new_width]
+
+        # Convert PIL-native RGB to BGR
+        bgr = pixels[:, :, 2::-1]
 
-        labels = list(zip(self.tag_names, preds[0].astype(float)))
+        if has_alpha:
+            # Composite onto white: 255 + (color - 255) * alpha
+            alpha = pixels[:, :, 3:].astype(np.float32)
+            alpha *= 1 / 255
 
-        # First 4 labels are actually ratings: pick one with argmax
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        rating = dict(ratings_names)
+            # Float32 buffers are composited in place, uint8 ones need a float32 scratch region
+            composite = region if region.dtype == np.float32 else np.empty(region.shape, dtype=np.float32)
 
-        # Then we have general tags: pick any where prediction confidence > threshold
-        general_names = [labels[i] for i in self.general_indexes]
-        general_res = dict(general_names)
+            np.subtract(bgr, 255, out=composite, dtype=np.float32)
+            composite *= alpha
+            composite += 255
+            np.rint(composite, out=composite)
 
-        # Everything else is characters: pick any where prediction confidence > threshold
-        character_names = [labels[i] for i in self.character_indexes]
-        character_res = dict(character_names)
+            if composite is not region:
+                region[...] = composite
+        else:
+            region[...] = bgr
+
+        return out
+
+    def predict_results(self, images: List[Image.Image], batch_size: int = None) -> List[PredictionResult]:
+        """
+        Predicts a list of images, running up to `batch_size` images per inference call.
+        Returns a compact PredictionResult for each image.
+        """
+        assert self.model is not None, "No model loaded"
 
-        return rating, general_res, character_res
+        session = self.session
+        with session.lock:
+            batch_size = min(batch_size or self.batch_size, self.batch_size)
+
+            results = []
+            for i in range(0, len(images), batch_size):
+                batch_images = images[i : i + batch_size]
+                batch = session.batch_buffer[: len(batch_images)]
+
+                for image, out in zip(batch_images, batch):
+                    self.prepare_image_into(image, out)
+
+                outputs = session.run(batch)
+
+                if self.top_k:
+                    results.extend(self._top_k_result(*row) for row in zip(*outputs))
+                else:
+                    # The output buffer is overwritten by the next batch, so the results get their own copy
+                    results.extend(
+                        PredictionResult(
+                            scores=scores,
+                            tag_names=self.tag_names,
+                            rating_indexes=self.rating_indexes,
+                            general_indexes=self.general_indexes,
+                            character_indexes=self.character_indexes,
+                        )
+                        for scores in outputs[0].copy()
+                    )
+
+            return results
+
+    def _top_k_result(
+        self, rating_scores: np.ndarray, top_k_scores: np.ndarray, top_k_indexes: np.ndarray
+    ) -> PredictionResult:
+        """
+        Builds the result of a top k model, whose scores are the rating scores followed by the top k scores.
+        Ratings in the top k are already covered, so they are not indexed a second time.
+        """
+        num_ratings = len(rating_scores)
+
+        return PredictionResult(
+            scores=np.concatenate([rating_scores, top_k_scores]),
+            tag_names=np.concatenate([self.tag_names[self.rating_indexes], self.tag_names[top_k_indexes]]),
+            rating_indexes=np.arange(num_ratings),
+            general_indexes=num_ratings + np.flatnonzero(self.is_general[top_k_indexes]),
+            character_indexes=num_ratings + np.flatnonzero(self.is_character[top_k_indexes]),
+        )
+
+    def predict_batch(self, images: List[Image.Image], batch_size: int = None, score_floor: float = 0.0):
+        """
+        Predicts a list of images, returning (rating, general, character) dicts for each image.
+        General and character tags scoring below `score_floor` are left out.
+        """
+        return [result.to_dicts(score_floor) for result in self.predict_results(images, batch_size=batch_size)]
+
+    def predict(self, image: Image, score_floor: float = 0.0):
+        return self.predict_batch([image], score_floor=score_floor)[0]
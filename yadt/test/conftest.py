@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+CAMIE_CATEGORIES = ["general", "character", "rating", "copyright"]
+CAMIE_TOTAL_TAGS = 40
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Models and tags are cached in a temporary directory instead of the model cache"""
+    from yadt import model_cache
+
+    monkeypatch.setattr(model_cache, "_cache_dir", tmp_path / "model_cache")
+    return tmp_path / "model_cache"
+
+
+def _camie_metadata():
+    # The last two tags have no entry in idx_to_tag, and tag_0 none in tag_to_category, so they are in "general"
+    return {
+        "total_tags": CAMIE_TOTAL_TAGS,
+        "idx_to_tag": {str(i): f"tag_{i}" for i in range(CAMIE_TOTAL_TAGS - 2)},
+        "tag_to_category": {
+            f"tag_{i}": CAMIE_CATEGORIES[i % len(CAMIE_CATEGORIES)] for i in range(1, CAMIE_TOTAL_TAGS - 2)
+        },
+    }
+
+
+@pytest.fixture
+def camie_metadata_path(tmp_path):
+    """The metadata.json of a small Camie model"""
+    path = tmp_path / "metadata.json"
+    path.write_text(json.dumps(_camie_metadata()))
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def camie_dataset():
+    from yadt.tagger_camie_dataset import TagDataset
+
+    return TagDataset.from_metadata(**_camie_metadata())
+
+
+@pytest.fixture(scope="module")
+def camie_full_model(camie_dataset):
+    """A small randomly initialized full Camie model, the same weights in every module"""
+    import torch
+
+    from yadt.tagger_camie_model import ImageTagger
+
+    torch.manual_seed(0)
+    return ImageTagger(
+        total_tags=camie_dataset.total_tags, dataset=camie_dataset, tag_context_size=8, pretrained=False
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def camie_initial_model(camie_dataset):
+    """A small randomly initialized initial-only Camie model"""
+    import torch
+
+    from yadt.tagger_camie_model import InitialOnlyImageTagger
+
+    torch.manual_seed(0)
+    return InitialOnlyImageTagger(total_tags=camie_dataset.total_tags, dataset=camie_dataset, pretrained=False).eval()
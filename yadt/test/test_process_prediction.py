@@ -72,3 +72,34 @@ def test_post_process_manual_edits(
 
     results = post_process_manual_edits(initial_tags, edited_tags, new_tags)
     assert results == wanted_tags
+
+
+@pytest.mark.parametrize(
+    "character_scores",
+    [[0.95, 0.7, 0.012, 0.01, 0.008], [0.4, 0.01, 0.009], [0.03, 0.01, 0.009]],
+    ids=["two tags", "one tag", "no tags"],
+)
+def test_mcut_with_floored_scores(character_scores):
+    np = pytest.importorskip("numpy")
+
+    from yadt.process_prediction import PredictionResult, post_process_prediction
+
+    general_scores = [0.95, 0.9, 0.6, 0.2, 0.04, 0.03]
+    scores = np.array([0.9, *general_scores, *character_scores], dtype=np.float32)
+    tag_names = np.array(
+        ["general", *[f"tag_{i}" for i in range(len(general_scores))], "hatsune_miku", "kagamine_rin"]
+        + [f"character_{i}" for i in range(len(character_scores) - 2)]
+    )
+    result = PredictionResult(
+        scores=scores,
+        tag_names=tag_names,
+        rating_indexes=np.arange(1),
+        general_indexes=np.arange(1, 1 + len(general_scores)),
+        character_indexes=np.arange(1 + len(general_scores), len(scores)),
+    )
+
+    def post_process(score_floor):
+        return post_process_prediction(*result.to_dicts(score_floor), 0.35, True, 0.35, True, False, False, False)
+
+    # MCut cuts at the largest gap, the floored scores keep the highest score below the floor to find it
+    assert post_process(0.05) == post_process(0.0)
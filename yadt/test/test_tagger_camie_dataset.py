@@ -0,0 +1,90 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def test_load_tag_dataset(camie_metadata_path, cache_dir):
+    from yadt.tagger_camie_dataset import load_tag_dataset
+
+    dataset = load_tag_dataset(camie_metadata_path)
+    assert len(list(cache_dir.glob("*-tags.npz"))) == 1
+
+    # Loaded a second time from the cache
+    dataset = load_tag_dataset(camie_metadata_path)
+
+    assert dataset.total_tags == 40
+    assert dataset.get_tag_info(0) == ("tag_0", "general")
+    assert dataset.get_tag_info(5) == ("tag_5", "character")
+    assert dataset.get_tag_info(39) == (f"unknown-{39}", "general")
+    assert dataset.get_tag_index("tag_7") == 7
+    assert dataset.get_tag_index("missing") is None
+
+
+def test_group_tags(camie_metadata_path):
+    from yadt.tagger_camie_dataset import load_tag_dataset
+
+    dataset = load_tag_dataset(camie_metadata_path)
+
+    rng = np.random.default_rng(3)
+    probabilities = rng.random((4, dataset.total_tags)).astype(np.float32)
+    probabilities[1, :] = 0.0  # No tags at all for the second image
+    probabilities[2, 4:12] = 0.75  # Ties keep the tag order
+
+    image_indices, tag_indices = np.nonzero(probabilities >= 0.5)
+    results = dataset.group_tags(4, image_indices, tag_indices, probabilities[image_indices, tag_indices])
+
+    for image_idx in range(4):
+        expected = {}
+        for idx in np.flatnonzero(probabilities[image_idx] >= 0.5):
+            tag_name, category = dataset.get_tag_info(idx)
+            expected.setdefault(category, []).append((tag_name, float(probabilities[image_idx, idx])))
+
+        expected = {category: sorted(tags, key=lambda x: x[1], reverse=True) for category, tags in expected.items()}
+        assert results[image_idx] == expected
+
+    # Without probabilities, tags keep their index order
+    names_only = dataset.group_tags(4, image_indices, tag_indices)
+    for category, tags in results[2].items():
+        assert names_only[2][category] == sorted([tag for tag, _ in tags], key=dataset.get_tag_index)
+
+
+def test_tail_scores(camie_metadata_path):
+    from yadt.tagger_camie_dataset import load_tag_dataset
+
+    dataset = load_tag_dataset(camie_metadata_path)
+
+    rng = np.random.default_rng(5)
+    probabilities = rng.random((3, dataset.total_tags)).astype(np.float32)
+    predictions = probabilities >= 0.5
+    predictions[2, :] = True  # Every tag predicted for the last image
+
+    tails = dataset.tail_scores(probabilities, predictions, "character")
+    characters = np.flatnonzero(dataset.category_codes == dataset.category_names.index("character"))
+
+    for image_idx in range(2):
+        assert (
+            tails[image_idx] == probabilities[image_idx, characters][probabilities[image_idx, characters] < 0.5].max()
+        )
+    assert tails[2] == -np.inf
+    assert (dataset.tail_scores(probabilities, predictions, "missing") == -np.inf).all()
+
+
+def test_download_thresholds_per_model(tmp_path, capsys):
+    pytest.importorskip("huggingface_hub")
+
+    from yadt.tagger_camie import Predictor
+
+    (tmp_path / "model").mkdir()
+    (tmp_path / "model/thresholds.json").write_text("{}")
+    predictor = Predictor()
+
+    # Without thresholds of its own, the initial-only model falls back to those of the full model
+    assert predictor.download_thresholds(str(tmp_path), full_model=False) == str(tmp_path / "model/thresholds.json")
+    assert "using the thresholds of the full model" in capsys.readouterr().out
+
+    (tmp_path / "model/thresholds_initial.json").write_text("{}")
+    assert predictor.download_thresholds(str(tmp_path), full_model=False) == str(
+        tmp_path / "model/thresholds_initial.json"
+    )
+    assert predictor.download_thresholds(str(tmp_path)) == str(tmp_path / "model/thresholds.json")
+    assert capsys.readouterr().out == ""
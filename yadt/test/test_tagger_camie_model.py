@@ -0,0 +1,200 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from PIL import Image
+
+
+def _small_images(model, monkeypatch):
+    # The backbone is slow on CPU, so the tests run it on small images
+    preprocess_image = type(model).preprocess_image
+    monkeypatch.setattr(model, "preprocess_image", lambda img: preprocess_image(model, img, image_size=64))
+    return model
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(2)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)) for h, w in [(48, 32), (32, 48), (40, 40)]
+    ]
+
+
+@pytest.mark.parametrize("model_fixture", ["camie_full_model", "camie_initial_model"])
+def test_predict_batch_matches_predict(model_fixture, images, request, monkeypatch):
+    model = _small_images(request.getfixturevalue(model_fixture), monkeypatch)
+
+    batched = model.predict_batch(images, threshold=0.5)
+    batch_tags = model.get_tags_from_predictions_batch(
+        batched["predictions"], probabilities=batched["refined_probabilities"]
+    )
+
+    for i, image in enumerate(images):
+        single = model.predict(image, threshold=0.5)
+        tags = model.get_tags_from_predictions(single["predictions"], probabilities=single["refined_probabilities"])
+
+        assert torch.allclose(batched["refined_probabilities"][i], single["refined_probabilities"][0], atol=1e-5)
+        assert batch_tags[i].keys() == tags.keys()
+        for category in tags:
+            assert [tag for tag, _ in batch_tags[i][category]] == [tag for tag, _ in tags[category]]
+
+
+def test_category_and_tag_thresholds(camie_initial_model, camie_dataset, images, monkeypatch):
+    model = _small_images(camie_initial_model, monkeypatch)
+
+    category_thresholds = {"general": 0.5, "character": 0.3}
+    tag_thresholds = {"tag_4": 0.9, "tag_2": 0.1, "unknown_tag": 0.5}
+
+    results = model.predict_batch(images, category_thresholds=category_thresholds, tag_thresholds=tag_thresholds)
+    probs = results["initial_probabilities"]
+
+    for idx in range(camie_dataset.total_tags):
+        tag_name, category = camie_dataset.get_tag_info(idx)
+        tag_threshold = tag_thresholds.get(tag_name, category_thresholds.get(category))
+
+        expected = probs[:, idx] >= tag_threshold if tag_threshold is not None else torch.zeros(len(images))
+        assert torch.equal(results["predictions"][:, idx], expected.float()), tag_name
+
+
+def test_bf16_precision_parity(camie_initial_model, images, monkeypatch):
+    from yadt.tagger_camie_model import set_precision
+
+    model = _small_images(camie_initial_model, monkeypatch)
+
+    fp32 = model.predict_batch(images)["refined_probabilities"]
+    try:
+        set_precision(model, "bf16")
+        if model.precision != "bf16":
+            pytest.skip("bf16 autocast is not supported here")
+
+        bf16 = model.predict_batch(images)["refined_probabilities"]
+    finally:
+        set_precision(model, "fp32")
+
+    assert bf16.dtype == torch.float32
+    assert (bf16 - fp32).abs().max().item() < 0.05
+
+
+def test_padded_channels_last_path_matches_eager(camie_full_model, images, monkeypatch):
+    model = _small_images(camie_full_model, monkeypatch)
+
+    eager = model.predict_batch(images[:2])["refined_probabilities"]
+
+    # The compiled path without the compilation itself, which takes minutes on CPU
+    monkeypatch.setattr(model, "compiled_forward", model.forward, raising=False)
+    monkeypatch.setattr(model, "compiled_batch_size", 4, raising=False)
+    padded = model.predict_batch(images[:2])["refined_probabilities"]
+
+    assert padded.shape == eager.shape
+    assert torch.allclose(padded, eager, atol=1e-5)
+
+
+@pytest.mark.parametrize("legacy_format", [False, True])
+def test_fast_load_matches_regular_load(
+    camie_initial_model, camie_metadata_path, images, tmp_path, monkeypatch, legacy_format
+):
+    from yadt.tagger_camie_model import load_model
+
+    # Checkpoints in the legacy format can't be memory-mapped, and are read into memory instead
+    state_dict_path = tmp_path / "model_initial_only.pt"
+    torch.save(camie_initial_model.state_dict(), state_dict_path, _use_new_zipfile_serialization=not legacy_format)
+
+    probabilities = []
+    for fast_load in (False, True):
+        model, _, _ = load_model(str(tmp_path), full=False, metadata_path=camie_metadata_path, fast_load=fast_load)
+        assert not any(tensor.is_meta for tensor in [*model.parameters(), *model.buffers()])
+
+        model = _small_images(model, monkeypatch)
+        probabilities.append(model.predict_batch(images)["initial_probabilities"])
+
+    assert torch.equal(probabilities[0], probabilities[1])
+
+
+def test_single_query_cross_attention_matches_full(camie_full_model, monkeypatch):
+    torch.manual_seed(1)
+    x = torch.rand(3, 3, 64, 64)
+
+    with torch.no_grad():
+        single_query = camie_full_model(x)
+
+        monkeypatch.setattr(camie_full_model, "single_query_cross_attention", False)
+        full = camie_full_model(x)
+
+    for single_query_preds, full_preds in zip(single_query, full):
+        assert torch.allclose(single_query_preds, full_preds, atol=1e-5)
+
+
+def test_cascade_refines_uncertain_images(camie_full_model, images, monkeypatch):
+    from yadt.tagger_camie_model import set_cascade
+
+    model = _small_images(camie_full_model, monkeypatch)
+    reference = model.predict_batch(images, threshold=0.5)
+
+    try:
+        # Every probability is within 1 of the threshold, so every image is refined
+        set_cascade(model, 1.0, threshold=0.5)
+        refined = model.predict_batch(images, threshold=0.5)
+        assert model.cascade_stats == {"images": len(images), "refined": len(images)}
+
+        # No probability is that close to the threshold, so the initial predictions are kept
+        set_cascade(model, 1e-12, threshold=0.5)
+        initial = model.predict_batch(images, threshold=0.5)
+        assert model.cascade_stats == {"images": len(images), "refined": 0}
+
+        # The band is centred on the decision threshold of the cascade, not on the threshold of the predictions
+        set_cascade(model, 1e-6, threshold=float(reference["initial_probabilities"][0, 0]))
+        floored = model.predict_batch(images, threshold=0.0)
+        assert model.cascade_stats["refined"] >= 1
+    finally:
+        set_cascade(model, None)
+
+    assert torch.allclose(refined["refined_probabilities"], reference["refined_probabilities"], atol=1e-5)
+    assert torch.equal(initial["refined_probabilities"], initial["initial_probabilities"])
+    assert torch.equal(initial["predictions"], (initial["initial_probabilities"] >= 0.5).float())
+    assert torch.allclose(floored["refined_probabilities"][0], reference["refined_probabilities"][0], atol=1e-5)
+
+
+def test_tag_context_size(camie_full_model, camie_dataset, images, monkeypatch):
+    from yadt.tagger_camie_model import set_tag_context_size
+
+    model = _small_images(camie_full_model, monkeypatch)
+    reference = model.predict_batch(images, threshold=0.5)
+
+    try:
+        set_tag_context_size(model, 4)
+        smaller = model.predict_batch(images, threshold=0.5)
+    finally:
+        set_tag_context_size(model, 8)
+
+    # Only the refinement attends to the context, the initial predictions stay the same
+    assert smaller["refined_probabilities"].shape == reference["refined_probabilities"].shape
+    assert torch.equal(smaller["initial_probabilities"], reference["initial_probabilities"])
+    assert torch.allclose(
+        model.predict_batch(images, threshold=0.5)["refined_probabilities"], reference["refined_probabilities"]
+    )
+
+    for size in (0, camie_dataset.total_tags + 1):
+        with pytest.raises(AssertionError):
+            set_tag_context_size(model, size)
+    assert model.tag_context_size == 8
+
+
+def test_dataset_cache_key_with_options():
+    from yadt import tagger_shared
+    from yadt.tagger_camie import CAMIE_MODEL_FULL
+
+    assert tagger_shared.dataset_cache_key(CAMIE_MODEL_FULL, kwargs={"cascade_band": None}) == CAMIE_MODEL_FULL
+    assert (
+        tagger_shared.dataset_cache_key(CAMIE_MODEL_FULL, kwargs={"cascade_band": 0.1})
+        == f"{CAMIE_MODEL_FULL} (cascade 0.1)"
+    )
+    assert (
+        tagger_shared.dataset_cache_key(CAMIE_MODEL_FULL, kwargs={"tag_context_size": 64, "cascade_band": 0.1})
+        == f"{CAMIE_MODEL_FULL} (context 64, cascade 0.1)"
+    )
+
+    # The threshold profile comes from the per-model config
+    kwargs = {"model_config": {CAMIE_MODEL_FULL: {"threshold_profile": "balanced"}}}
+    assert tagger_shared.dataset_cache_key(CAMIE_MODEL_FULL, kwargs=kwargs) == f"{CAMIE_MODEL_FULL} (profile balanced)"
@@ -0,0 +1,81 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("onnxruntime")
+
+from PIL import Image
+
+IMAGE_SIZE = 64
+
+
+@pytest.fixture(scope="module")
+def models(camie_full_model, camie_dataset, tmp_path_factory):
+    from yadt.tagger_camie_model import export_onnx
+
+    model, dataset = camie_full_model, camie_dataset
+
+    # The backbone is slow on CPU, so the tests run it on small images
+    preprocess_image = type(model).preprocess_image
+    model.preprocess_image = lambda img: preprocess_image(model, img, image_size=IMAGE_SIZE)
+
+    onnx_path = str(tmp_path_factory.mktemp("camie") / "model.onnx")
+    export_onnx(model, onnx_path, image_size=IMAGE_SIZE)
+
+    return model, onnx_path, dataset
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(2)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)).convert(mode)
+        for (h, w), mode in [((48, 32), "RGB"), ((32, 48), "RGBA"), ((40, 40), "L")]
+    ]
+
+
+def test_onnx_matches_torch(models, images):
+    from yadt.tagger_camie_onnx import OnnxImageTagger
+    from yadt.tagger_camie_preprocess import letterbox_into
+
+    model, onnx_path, dataset = models
+    onnx_model = OnnxImageTagger(onnx_path, dataset, batch_size=2)
+
+    torch_results = model.predict_batch(images, threshold=0.5)
+    onnx_results = onnx_model.predict_batch(images, threshold=0.5)
+
+    for key in ("initial_probabilities", "refined_probabilities"):
+        assert np.allclose(onnx_results[key], torch_results[key].numpy(), atol=1e-5)
+
+    # Batches that are already preprocessed are split over the batch buffer the same way
+    batch = np.stack([letterbox_into(image, np.empty((3, IMAGE_SIZE, IMAGE_SIZE), np.float32)) for image in images])
+    preprocessed_results = onnx_model.predict_preprocessed(batch, threshold=0.5)
+    for key in ("refined_probabilities", "predictions"):
+        assert np.array_equal(preprocessed_results[key], onnx_results[key])
+
+    torch_tags = model.get_tags_from_predictions_batch(
+        torch_results["predictions"], probabilities=torch_results["refined_probabilities"]
+    )
+    onnx_tags = onnx_model.get_tags_from_predictions_batch(
+        onnx_results["predictions"], probabilities=onnx_results["refined_probabilities"]
+    )
+
+    for torch_image_tags, onnx_image_tags in zip(torch_tags, onnx_tags):
+        assert torch_image_tags.keys() == onnx_image_tags.keys()
+        for category in torch_image_tags:
+            assert [tag for tag, _ in torch_image_tags[category]] == [tag for tag, _ in onnx_image_tags[category]]
+
+
+def test_int8_variant(models, images):
+    from yadt import onnx_session
+    from yadt.tagger_camie_onnx import OnnxImageTagger
+
+    model, onnx_path, dataset = models
+    int8_model = OnnxImageTagger(onnx_session.quantized_model(onnx_path), dataset, batch_size=2)
+
+    fp32 = model.predict_batch(images)["refined_probabilities"].numpy()
+    int8 = int8_model.predict_batch(images)["refined_probabilities"]
+
+    assert int8.shape == fp32.shape
+    assert np.abs(int8 - fp32).max() < 0.1
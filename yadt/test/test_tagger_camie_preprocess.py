@@ -0,0 +1,65 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from PIL import Image
+
+IMAGE_SIZE = 64
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(4)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)).convert(mode)
+        for (h, w), mode in [((48, 32), "RGB"), ((32, 48), "RGBA"), ((40, 40), "L"), ((30, 70), "P"), ((70, 30), "LA")]
+    ]
+
+
+def test_preprocessor_matches_preprocess_image(images):
+    from yadt.tagger_camie_model import ImageTagger
+    from yadt.tagger_camie_preprocess import Preprocessor
+
+    expected = torch.stack([ImageTagger.preprocess_image(None, image, image_size=IMAGE_SIZE) for image in images])
+
+    preprocessor = Preprocessor(batch_size=2, image_size=IMAGE_SIZE, num_workers=2)
+    batches = [batch.copy() for batch in preprocessor.batches(images)]
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert np.array_equal(np.concatenate(batches), expected.numpy())
+
+
+def test_preprocessor_stopped_early(images):
+    from yadt.tagger_camie_preprocess import Preprocessor
+
+    preprocessor = Preprocessor(batch_size=2, image_size=IMAGE_SIZE)
+
+    # Leaving the loop early releases the preprocessor for the next call
+    for batch in preprocessor.batches(images):
+        break
+
+    assert len(list(preprocessor.batches(images[:3]))) == 2
+
+
+def test_preprocessor_slices_one_batch_ahead(images):
+    from yadt.tagger_camie_preprocess import Preprocessor
+
+    class Images(list):
+        slices = []
+
+        def __getitem__(self, index):
+            self.slices.append((index.start, index.stop))
+            return super().__getitem__(index)
+
+    preprocessor = Preprocessor(batch_size=2, image_size=IMAGE_SIZE)
+
+    batches = preprocessor.batches(Images(images))
+    next(batches)
+    assert Images.slices == [(None, 2), (2, 4)]
+
+    assert len(list(batches)) == 2
+    assert Images.slices == [(None, 2), (2, 4), (4, 6)]
+
+    preprocessor.shutdown()
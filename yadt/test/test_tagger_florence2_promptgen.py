@@ -0,0 +1,156 @@
+import pytest
+
+pytest.importorskip("huggingface_hub")
+torch = pytest.importorskip("torch")
+
+from PIL import Image
+
+# Token ids of the fake tokenizer, decoded like the BART tokenizer of Florence-2
+VOCAB = [
+    "<s>",
+    "<pad>",
+    "</s>",
+    ",",
+    "1girl",
+    " solo",
+    " cat",
+    " no",
+    " humans",
+    "1boy",
+    " long",
+    " ha",
+    "sky",
+    " cat,",
+]
+BOS, PAD, EOS, COMMA = range(4)
+
+
+def _ids(text: str):
+    return [VOCAB.index(token) for token in text.split("|")]
+
+
+class FakeTokenizer:
+    eos_token_id = EOS
+    pad_token_id = PAD
+
+    def get_vocab(self):
+        return {token: token_id for token_id, token in enumerate(VOCAB)}
+
+
+class FakeProcessor:
+    """The parts of the Florence-2 processor the predictor uses"""
+
+    tokenizer = FakeTokenizer()
+
+    def __call__(self, text, images, return_tensors, padding):
+        assert len(text) == len(images)
+        return {"input_ids": torch.zeros(len(images), 1, dtype=torch.long), "pixel_values": images}
+
+    def batch_decode(self, generated_ids, skip_special_tokens):
+        return ["".join(VOCAB[token_id] for token_id in token_ids) for token_ids in generated_ids.tolist()]
+
+    def post_process_generation(self, generated_text, task, image_size):
+        for token in ("<s>", "<pad>", "</s>"):
+            generated_text = generated_text.replace(token, "")
+        return {task: generated_text}
+
+
+class FakeModel:
+    """Generates fixed sequences in order, padded per batch, starting with the decoder start token like Florence-2"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.calls = []
+
+    def generate(self, input_ids, pixel_values, **kwargs):
+        assert all(image.mode == "RGB" for image in pixel_values)
+        self.calls.append((len(input_ids), kwargs))
+
+        outputs = [[EOS, BOS, *self.outputs.pop(0)] for _ in range(len(input_ids))]
+        length = max(len(output) for output in outputs)
+        return torch.tensor([output + [PAD] * (length - len(output)) for output in outputs])
+
+
+@pytest.fixture
+def predictor():
+    from yadt.tagger_florence2_promptgen import Predictor
+
+    predictor = Predictor()
+    predictor.processor = FakeProcessor()
+    predictor.repetition_window = 0
+    return predictor
+
+
+def test_predict_batch_decoding_profiles(predictor):
+    from yadt.tagger_florence2_promptgen import DECODING_PROFILES, DEFAULT_DECODING_PROFILE
+
+    images = [Image.new("RGBA", (16, 16)), Image.new("RGB", (8, 16)), Image.new("L", (16, 8)), Image.new("RGB", (8, 8))]
+    predictor.model = FakeModel(
+        [
+            _ids("1girl|,| solo|</s>"),
+            _ids(" cat|,| no| humans|</s>"),
+            # Ran out of tokens in the middle of a tag
+            _ids("1boy|,| long| ha"),
+            _ids("sky|</s>"),
+        ]
+    )
+
+    predictions = predictor.predict_batch(images, batch_size=3, decoding_profile="greedy, 256 tokens")
+
+    # The tag cut off by the token budget is dropped
+    assert [general for _, general, _ in predictions] == [
+        {"1girl": 1.0, "solo": 1.0},
+        {"cat": 1.0, "no humans": 1.0},
+        {"1boy": 1.0},
+        {"sky": 1.0},
+    ]
+    assert [batch_size for batch_size, _ in predictor.model.calls] == [3, 1]
+    assert predictor.model.calls[0][1] == {
+        "do_sample": False,
+        "stopping_criteria": None,
+        **DECODING_PROFILES["greedy, 256 tokens"],
+    }
+
+    predictor.model = FakeModel([_ids("sky|</s>")])
+    predictor.predict(images[0])
+    assert predictor.model.calls[0][1]["num_beams"] == DECODING_PROFILES[DEFAULT_DECODING_PROFILE]["num_beams"]
+
+    with pytest.raises(AssertionError):
+        predictor.predict_batch(images, decoding_profile="unknown")
+
+
+def test_repetition_stopping_criteria():
+    from yadt.tagger_florence2_promptgen_model import RepetitionStoppingCriteria, separator_token_ids
+
+    # The comma merged with a tag is a separator too
+    assert separator_token_ids(FakeTokenizer()) == [COMMA, VOCAB.index(" cat,")]
+    criteria = RepetitionStoppingCriteria(separator_token_ids(FakeTokenizer()), window=3)
+
+    looping = _ids("<s>|1girl|,| solo|,| cat|,| solo|,| cat|,| solo|,")
+    new_tags = _ids("<s>|1girl|,| solo|,| cat|,| solo|,| cat|,| no|,")
+    mid_tag = _ids("<s>|1girl|,| solo|,| cat|,| solo|,| cat|,| solo|,| no")
+
+    assert criteria.is_repeating(looping)
+    assert not criteria.is_repeating(looping[:-2])
+    assert not criteria.is_repeating(new_tags)
+
+    # Only the sequences that just completed a repeated tag are stopped
+    is_done = criteria(torch.tensor([looping + [PAD], new_tags + [PAD], mid_tag]), scores=None)
+    assert is_done.tolist() == [False, False, False]
+    assert criteria(torch.tensor([looping, new_tags]), scores=None).tolist() == [True, False]
+
+    merged = _ids("<s>|1girl|,| solo| cat,| solo| cat,| solo| cat,| solo| cat,")
+    assert criteria.is_repeating(merged)
+    assert criteria(torch.tensor([merged, looping[:-2]]), scores=None).tolist() == [True, False]
+
+
+def test_dataset_cache_key_per_decoding_profile():
+    from yadt import tagger_shared
+    from yadt.tagger_florence2_promptgen import DEFAULT_DECODING_PROFILE, FLORENCE2_PROMPTGEN_BASE
+
+    # The default profile keeps the key of the results cached before there were profiles
+    assert (
+        tagger_shared.dataset_cache_key(FLORENCE2_PROMPTGEN_BASE, DEFAULT_DECODING_PROFILE) == FLORENCE2_PROMPTGEN_BASE
+    )
+    assert tagger_shared.dataset_cache_key(FLORENCE2_PROMPTGEN_BASE, "greedy") == f"{FLORENCE2_PROMPTGEN_BASE} (greedy)"
+    assert tagger_shared.dataset_cache_key("SmilingWolf/wd-vit-tagger-v3", "greedy") == "SmilingWolf/wd-vit-tagger-v3"
@@ -0,0 +1,248 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+onnx = pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from PIL import Image
+
+TAGS = [
+    ("general", 9),
+    ("sensitive", 9),
+    ("questionable", 9),
+    ("explicit", 9),
+    ("1girl", 0),
+    ("solo", 0),
+    ("long_hair", 0),
+    ("smile", 0),
+    ("hatsune_miku", 4),
+    ("kagamine_rin", 4),
+]
+TAGS_INDEX = {name: i for i, (name, _) in enumerate(TAGS)}
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """Builds a tiny WD-style model (NHWC float32 in, sigmoid scores out) with a matching label file"""
+    from onnx import TensorProto, helper, numpy_helper
+
+    path = tmp_path_factory.mktemp("wd-model")
+
+    rng = np.random.default_rng(0)
+    weights = rng.normal(size=(3, len(TAGS))).astype(np.float32) / 64
+
+    graph = helper.make_graph(
+        [
+            helper.make_node("ReduceMean", ["input", "axes"], ["pooled"], keepdims=0),
+            helper.make_node("MatMul", ["pooled", "weights"], ["logits"]),
+            helper.make_node("Sigmoid", ["logits"], ["output"]),
+        ],
+        "wd-test",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", 32, 32, 3])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", len(TAGS)])],
+        initializer=[
+            numpy_helper.from_array(np.array([1, 2], dtype=np.int64), "axes"),
+            numpy_helper.from_array(weights, "weights"),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 8
+    onnx.save(model, path / "model.onnx")
+
+    with open(path / "selected_tags.csv", "w") as f:
+        f.write("tag_id,name,category,count\n")
+        for i, (name, category) in enumerate(TAGS):
+            f.write(f"{i},{name},{category},{1000 - i}\n")
+
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def images():
+    rng = np.random.default_rng(1)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8))
+        for h, w in [(48, 32), (32, 48), (20, 20), (64, 64), (33, 17)]
+    ]
+
+
+def test_predict_batch_matches_predict(model_dir, images):
+    from yadt.tagger_smilingwolf import Predictor
+
+    predictor = Predictor()
+    predictor.load_model(model_dir, batch_size=2)
+
+    batched = predictor.predict_batch(images)
+    single = [predictor.predict(image) for image in images]
+
+    assert len(batched) == len(images)
+
+    for batched_res, single_res in zip(batched, single):
+        for batched_tags, single_tags in zip(batched_res, single_res):
+            assert batched_tags.keys() == single_tags.keys()
+            assert np.allclose(list(batched_tags.values()), list(single_tags.values()), atol=1e-6)
+
+
+def test_predict_categories(model_dir, images):
+    from yadt.tagger_smilingwolf import Predictor
+
+    predictor = Predictor()
+    predictor.load_model(model_dir)
+
+    rating, general_res, character_res = predictor.predict(images[0])
+
+    assert list(rating.keys()) == ["general", "sensitive", "questionable", "explicit"]
+    assert list(general_res.keys()) == ["1girl", "solo", "long_hair", "smile"]
+    assert list(character_res.keys()) == ["hatsune_miku", "kagamine_rin"]
+
+
+def test_label_cache(model_dir, cache_dir):
+    import os
+
+    from yadt.tagger_smilingwolf import load_labels
+
+    tag_names, rating_indexes, general_indexes, character_indexes = load_labels(
+        os.path.join(model_dir, "selected_tags.csv")
+    )
+
+    assert len(list(cache_dir.glob("*-labels.npz"))) == 1
+    assert tag_names.tolist() == [name for name, _ in TAGS]
+    assert rating_indexes.tolist() == [0, 1, 2, 3]
+    assert general_indexes.tolist() == [4, 5, 6, 7]
+    assert character_indexes.tolist() == [8, 9]
+
+
+def test_predict_score_floor(model_dir, images):
+    from yadt.process_prediction import SCORE_FLOOR_TAIL
+    from yadt.tagger_smilingwolf import Predictor
+
+    predictor = Predictor()
+    predictor.load_model(model_dir)
+
+    result = predictor.predict_results(images[:1])[0]
+    assert result.scores.dtype == np.float32 and result.scores.shape == (len(TAGS),)
+
+    score_floor = float(np.median(result.scores[result.general_indexes]))
+    rating, general_res, character_res = predictor.predict(images[0], score_floor=score_floor)
+    full_rating, full_general_res, full_character_res = predictor.predict(images[0])
+
+    assert rating == full_rating
+    assert SCORE_FLOOR_TAIL not in full_general_res
+
+    # The highest score left out is kept for MCut
+    for res, full_res in ((general_res, full_general_res), (character_res, full_character_res)):
+        expected = {tag: score for tag, score in full_res.items() if score >= score_floor}
+        if len(expected) < len(full_res):
+            expected[SCORE_FLOOR_TAIL] = max(score for score in full_res.values() if score < score_floor)
+        assert res == expected
+
+
+def test_optimized_model_cache(model_dir, images, cache_dir):
+    from yadt import onnx_session
+    from yadt.tagger_smilingwolf import Predictor
+
+    uncached = Predictor()
+    uncached.load_model(model_dir, optimized_model_cache=False)
+    assert not cache_dir.exists() or len(list(cache_dir.glob("*.ort"))) == 0
+
+    cached = Predictor()
+    cached.load_model(model_dir)
+    assert len(list(cache_dir.glob("*.ort"))) == 1
+
+    # Models optimized for another instruction set are never loaded
+    assert f"-{onnx_session.cpu_instruction_set()}-" in next(cache_dir.glob("*.ort")).name
+
+    # The second load has to come from the cache, not write a new optimized model
+    cached.load_model(model_dir)
+    assert len(list(cache_dir.glob("*.ort"))) == 1
+
+    for cached_tags, uncached_tags in zip(cached.predict(images[0]), uncached.predict(images[0])):
+        assert np.allclose(list(cached_tags.values()), list(uncached_tags.values()), atol=1e-6)
+
+
+def test_int8_variant(model_dir, images, cache_dir):
+    from yadt.tagger_smilingwolf import INT8_VARIANT_SUFFIX, Predictor
+
+    fp32 = Predictor()
+    fp32.load_model(model_dir)
+
+    int8 = Predictor()
+    int8.load_model(model_dir + INT8_VARIANT_SUFFIX)
+    assert len(list(cache_dir.glob("*-int8.onnx"))) == 1
+
+    for int8_tags, fp32_tags in zip(int8.predict(images[0]), fp32.predict(images[0])):
+        assert int8_tags.keys() == fp32_tags.keys()
+        assert np.allclose(list(int8_tags.values()), list(fp32_tags.values()), atol=0.05)
+
+
+def test_uint8_input(model_dir, images, cache_dir):
+    from yadt.tagger_smilingwolf import Predictor
+
+    fp32 = Predictor()
+    fp32.load_model(model_dir)
+
+    uint8 = Predictor()
+    uint8.load_model(model_dir, uint8_input=True)
+    assert len(list(cache_dir.glob("*-uint8-input.onnx"))) == 1
+    assert uint8.session.batch_buffer.dtype == np.uint8
+
+    for uint8_result, fp32_result in zip(uint8.predict_results(images), fp32.predict_results(images)):
+        assert np.allclose(uint8_result.scores, fp32_result.scores, atol=1e-6)
+
+
+def test_top_k(model_dir, images, cache_dir):
+    from yadt.tagger_smilingwolf import Predictor
+
+    full = Predictor()
+    full.load_model(model_dir)
+
+    top_k = Predictor()
+    top_k.load_model(model_dir, top_k=3, batch_size=2)
+    assert len(list(cache_dir.glob("*-top3.onnx"))) == 1
+
+    for full_result, top_k_result in zip(full.predict_results(images), top_k.predict_results(images)):
+        rating, general_res, character_res = top_k_result.to_dicts()
+        full_rating, full_general_res, full_character_res = full_result.to_dicts()
+
+        best = set(np.argsort(-full_result.scores, kind="stable")[:3].tolist())
+        assert set(general_res) == {tag for tag in full_general_res if TAGS_INDEX[tag] in best}
+        assert set(character_res) == {tag for tag in full_character_res if TAGS_INDEX[tag] in best}
+
+        assert rating == pytest.approx(full_rating)
+        assert general_res == pytest.approx({tag: full_general_res[tag] for tag in general_res})
+        assert character_res == pytest.approx({tag: full_character_res[tag] for tag in character_res})
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "LA", "P"])
+def test_prepare_image_into_matches_reference(mode):
+    from yadt.tagger_smilingwolf import Predictor
+
+    predictor = Predictor()
+    predictor.model_target_size = 448
+
+    # Smooth gradients, so resizing before padding only differs from the reference along the padding edge
+    rng = np.random.default_rng(2)
+    image = Image.fromarray(rng.integers(0, 256, size=(8, 12, 4), dtype=np.uint8), "RGBA")
+    image = image.resize((1200, 800), Image.BILINEAR).convert(mode)
+
+    reference = predictor.prepare_image(image)[0]
+    out = np.empty((448, 448, 3), dtype=np.float32)
+    predictor.prepare_image_into(image, out)
+
+    assert np.abs(reference - out).mean() < 1.0
+
+
+def test_dataset_cache_key_with_top_k():
+    from yadt import tagger_shared
+
+    repo = "SmilingWolf/wd-vit-tagger-v3"
+
+    assert tagger_shared.dataset_cache_key(repo, kwargs={"top_k": None}) == repo
+    assert tagger_shared.dataset_cache_key(repo, kwargs={"top_k": 50}) == f"{repo} (top 50)"
+
+    # The per-model config takes precedence, like it does when loading the model
+    kwargs = {"top_k": None, "model_config": {repo: {"top_k": 20}}}
+    assert tagger_shared.dataset_cache_key(repo, kwargs=kwargs) == f"{repo} (top 20)"
+
+    # Entries cached at one score floor are never reused at another
+    assert tagger_shared.dataset_cache_key(repo, kwargs=kwargs, score_floor=0.05) == f"{repo} (top 20, floor 0.05)"